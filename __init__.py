@@ -2,6 +2,10 @@
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import attempt
+from . import carrier
+from . import ir
+from . import party
 from . import shipment
 from . import sale
 from . import manifest
@@ -9,6 +13,14 @@ from . import manifest
 
 def register():
     Pool.register(
+        carrier.CarrierApi,
+        carrier.CarrierApiCarrier,
+        carrier.CarrierApiService,
+        ir.ActionReport,
+        ir.Cron,
+        party.Address,
+        party.Country,
+        party.Subdivision,
         shipment.ShipmentOut,
         shipment.CarrierSendShipmentsStart,
         shipment.CarrierSendShipmentsResult,
@@ -17,6 +29,7 @@ def register():
         sale.Sale,
         manifest.CarrierManifestStart,
         manifest.CarrierEnterManifest,
+        attempt.CarrierSendAttempt,
         module='carrier_send_shipments', type_='model')
     Pool.register(
         shipment.CarrierSendShipments,
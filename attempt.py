@@ -0,0 +1,88 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from datetime import datetime, timedelta
+
+from sql.functions import CurrentTimestamp
+from trytond.config import config
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['CarrierSendAttempt']
+
+retention_days = config.getint('carrier_send_shipments',
+    'send_attempt_retention', default=90)
+
+
+class CarrierSendAttempt(ModelSQL, ModelView):
+    'Carrier Send Attempt'
+    __name__ = 'carrier.send.attempt'
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, readonly=True, ondelete='CASCADE')
+    api = fields.Many2One('carrier.api', 'Carrier API', readonly=True,
+        ondelete='SET NULL')
+    method = fields.Char('Method', readonly=True)
+    start = fields.Timestamp('Start', required=True, readonly=True)
+    end = fields.Timestamp('End', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='Seconds of the call to the carrier API')
+    batch_size = fields.Integer('Batch Size', readonly=True,
+        help='Number of shipments sent in the same call')
+    outcome = fields.Selection([
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ('error', 'Error'),
+            ('rejected', 'Rejected'),
+            ], 'Outcome', required=True, readonly=True,
+        help='Sent: the carrier returned a tracking reference.\n'
+        'Failed: the carrier returned an error.\n'
+        'Error: the call to the carrier raised an exception.\n'
+        'Rejected: the carrier API was unavailable and was not called.')
+    error = fields.Text('Error', readonly=True)
+    label_size = fields.Integer('Label Size', readonly=True,
+        help='Bytes of the label returned by the carrier')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.start, Index.Range())),
+                Index(t,
+                    (t.api, Index.Equality()),
+                    (t.start, Index.Range())),
+                Index(t, (t.shipment, Index.Equality())),
+                })
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @classmethod
+    def log(cls, values):
+        '''Insert the attempts from a list of dictionaries
+
+        The rows are inserted with a single query per slice instead of
+        creating the records one by one.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        names = ['shipment', 'api', 'method', 'start', 'end', 'duration',
+            'batch_size', 'outcome', 'error', 'label_size']
+        columns = [table.create_uid, table.create_date] + [
+            getattr(table, n) for n in names]
+        for sub_values in grouped_slice(values):
+            cursor.execute(*table.insert(columns, [
+                        [transaction.user, CurrentTimestamp()]
+                        + [v.get(n) for n in names]
+                        for v in sub_values]))
+
+    @classmethod
+    def purge(cls):
+        'Delete the attempts older than the send_attempt_retention days'
+        if not retention_days:
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        threshold = datetime.now() - timedelta(days=retention_days)
+        cursor.execute(*table.delete(where=table.start < threshold))
@@ -0,0 +1,144 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .session import carrier_session
+
+__all__ = ['CarrierApi', 'CarrierApiCarrier', 'CarrierApiService',
+    'cache_stats']
+
+CACHE_PREFIX = 'carrier_send_shipments.'
+
+
+def cache_stats():
+    'Return the hit and miss counts of the caches of the module'
+    return [s for s in Cache.stats() if s['name'].startswith(CACHE_PREFIX)]
+
+
+class CarrierApi(metaclass=PoolMeta):
+    __name__ = 'carrier.api'
+    _carrier_api_cache = Cache(CACHE_PREFIX + 'carrier_api', context=False)
+    _carrier_services_cache = Cache(CACHE_PREFIX + 'carrier_services',
+        context=False)
+
+    @classmethod
+    def get_carrier_api(cls, carrier):
+        'Return the carrier API of the carrier or None'
+        if not carrier:
+            return None
+        key = (int(carrier), Transaction().context.get('company'))
+        api_id = cls._carrier_api_cache.get(key, -1)
+        if api_id == -1:
+            apis = cls.search([('carriers', 'in', [key[0]])], limit=1)
+            api_id = apis[0].id if apis else None
+            cls._carrier_api_cache.set(key, api_id)
+        if api_id is None:
+            return None
+        return cls(api_id)
+
+    @classmethod
+    def get_carrier_services(cls, carriers):
+        '''Return a dictionary with the ids of the services of the APIs of
+        each carrier'''
+        pool = Pool()
+        ApiCarrier = pool.get('carrier.api-carrier.carrier')
+        Service = pool.get('carrier.api.service')
+
+        result = {}
+        missing = []
+        for carrier_id in {int(c) for c in carriers}:
+            service_ids = cls._carrier_services_cache.get(carrier_id)
+            if service_ids is None:
+                missing.append(carrier_id)
+            else:
+                result[carrier_id] = service_ids
+        if not missing:
+            return result
+
+        api_carriers = []
+        for sub_ids in grouped_slice(missing):
+            api_carriers += ApiCarrier.search([
+                    ('carrier', 'in', list(sub_ids)),
+                    ])
+        api_services = {}
+        api_ids = list({a.api.id for a in api_carriers})
+        for sub_ids in grouped_slice(api_ids):
+            for service in Service.search([('api', 'in', list(sub_ids))]):
+                api_services.setdefault(service.api.id, []).append(service.id)
+
+        for carrier_id in missing:
+            result[carrier_id] = []
+        for api_carrier in api_carriers:
+            result[api_carrier.carrier.id].extend(
+                api_services.get(api_carrier.api.id, []))
+        for carrier_id in missing:
+            cls._carrier_services_cache.set(carrier_id, result[carrier_id])
+        return result
+
+    def carrier_session(self):
+        '''Return a context manager which borrows the pooled HTTP session of
+        the API, for the carrier backends'''
+        return carrier_session(self)
+
+    @classmethod
+    def create(cls, vlist):
+        cls._carrier_api_cache.clear()
+        cls._carrier_services_cache.clear()
+        return super(CarrierApi, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._carrier_api_cache.clear()
+        cls._carrier_services_cache.clear()
+        super(CarrierApi, cls).write(*args)
+
+    @classmethod
+    def delete(cls, apis):
+        cls._carrier_api_cache.clear()
+        cls._carrier_services_cache.clear()
+        super(CarrierApi, cls).delete(apis)
+
+
+class CarrierApiCarrier(metaclass=PoolMeta):
+    __name__ = 'carrier.api-carrier.carrier'
+
+    @classmethod
+    def create(cls, vlist):
+        CarrierApi._carrier_api_cache.clear()
+        CarrierApi._carrier_services_cache.clear()
+        return super(CarrierApiCarrier, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        CarrierApi._carrier_api_cache.clear()
+        CarrierApi._carrier_services_cache.clear()
+        super(CarrierApiCarrier, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        CarrierApi._carrier_api_cache.clear()
+        CarrierApi._carrier_services_cache.clear()
+        super(CarrierApiCarrier, cls).delete(records)
+
+
+class CarrierApiService(metaclass=PoolMeta):
+    __name__ = 'carrier.api.service'
+
+    @classmethod
+    def create(cls, vlist):
+        CarrierApi._carrier_services_cache.clear()
+        return super(CarrierApiService, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        CarrierApi._carrier_services_cache.clear()
+        super(CarrierApiService, cls).write(*args)
+
+    @classmethod
+    def delete(cls, services):
+        CarrierApi._carrier_services_cache.clear()
+        super(CarrierApiService, cls).delete(services)
@@ -0,0 +1,282 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['phase', 'count_queries', 'snapshot', 'reset', 'labels_size']
+
+logger = logging.getLogger(__name__)
+
+SINKS = {'log', 'snapshot', 'file'}
+sinks = {s.strip() for s in config.get('carrier_send_shipments',
+        'instrument', default='').split(',')} & SINKS
+metrics_file = config.get('carrier_send_shipments', 'instrument_file',
+    default=None)
+if 'file' in sinks and not metrics_file:
+    sinks.discard('file')
+enabled = bool(sinks)
+
+_local = threading.local()
+_lock = threading.Lock()
+_counters = {}
+
+
+class Record(object):
+    'Measures of a phase'
+    __slots__ = ('name', 'method', 'duration', 'queries', 'bytes', 'items')
+
+    def __init__(self, name, method=None):
+        self.name = name
+        self.method = method
+        self.duration = 0
+        self.queries = 0
+        self.bytes = 0
+        self.items = 0
+
+    def __bool__(self):
+        return True
+
+    def add(self, bytes=0, items=0):
+        self.bytes += bytes
+        self.items += items
+
+
+class _NullRecord(object):
+    'Record used when the instrumentation is disabled'
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def add(self, bytes=0, items=0):
+        pass
+
+
+_NULL_RECORD = _NullRecord()
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return _NULL_RECORD
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def _count_query(*args):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+
+
+class _QueryFilter(logging.Filter):
+    'Count the queries logged by the PostgreSQL cursor'
+
+    def filter(self, record):
+        if getattr(_local, 'count_depth', 0):
+            _count_query()
+        # the records are only emitted if DEBUG was enabled by the user
+        return _query_logger_level is None
+
+
+_query_logger = logging.getLogger('trytond.backend.postgresql.database')
+_query_filter = _QueryFilter()
+_query_lock = threading.Lock()
+_query_counters = 0
+_query_logger_level = None
+_sqlite_logger = logging.getLogger('trytond.backend.sqlite.database')
+
+
+def _start_query_count():
+    global _query_counters, _query_logger_level
+    with _query_lock:
+        if not _query_counters:
+            _query_logger.addFilter(_query_filter)
+            # the cursor logs each query only when DEBUG is enabled
+            if not _query_logger.isEnabledFor(logging.DEBUG):
+                _query_logger_level = _query_logger.level
+                _query_logger.setLevel(logging.DEBUG)
+        _query_counters += 1
+
+
+def _stop_query_count():
+    global _query_counters, _query_logger_level
+    with _query_lock:
+        _query_counters -= 1
+        if not _query_counters:
+            _query_logger.removeFilter(_query_filter)
+            if _query_logger_level is not None:
+                _query_logger.setLevel(_query_logger_level)
+                _query_logger_level = None
+
+
+def _sqlite_trace_callback():
+    'Return the trace callback set by the SQLite backend of trytond'
+    if _sqlite_logger.isEnabledFor(logging.DEBUG):
+        return _sqlite_logger.debug
+
+
+@contextmanager
+def count_queries():
+    '''Yield a function which returns the number of SQL queries executed by
+    the thread since the start
+
+    The queries are counted with the trace callback of the SQLite connection
+    or with the logger of the PostgreSQL cursor, which are restored once the
+    outermost count ends.
+    '''
+    depth = getattr(_local, 'count_depth', 0)
+    connection = previous = None
+    if not depth:
+        if backend.name == 'sqlite':
+            connection = Transaction().connection
+            previous = _sqlite_trace_callback()
+            if previous:
+                def callback(statement):
+                    _count_query()
+                    previous(statement)
+            else:
+                callback = _count_query
+            connection.set_trace_callback(callback)
+        elif backend.name == 'postgresql':
+            _start_query_count()
+    _local.count_depth = depth + 1
+    start = getattr(_local, 'queries', 0)
+    try:
+        yield lambda: getattr(_local, 'queries', 0) - start
+    finally:
+        _local.count_depth = depth
+        if connection:
+            connection.set_trace_callback(previous)
+        elif not depth and backend.name == 'postgresql':
+            _stop_query_count()
+
+
+def phase(name, method=None):
+    '''Return a context manager which measures the phase
+
+    It yields a record to which the byte size and the number of items
+    processed are added with record.add(bytes=..., items=...). The record is
+    false when the instrumentation is disabled so the measures which are
+    expensive to compute can be skipped.
+    The sinks are set with the instrument option as a comma-separated list of
+    "log", "snapshot" and "file" (written to the instrument_file option).
+    '''
+    if not enabled:
+        return _NULL_PHASE
+    return _phase(name, method)
+
+
+@contextmanager
+def _phase(name, method):
+    record = Record(name, method)
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        with count_queries() as queries:
+            yield record
+    finally:
+        record.duration = time.perf_counter() - start
+        record.queries = queries()
+        _local.depth = depth
+        _emit(record, depth)
+
+
+def _emit(record, depth):
+    if 'log' in sinks:
+        name = record.name
+        if record.method:
+            name += '[%s]' % record.method
+        logger.info('%s%s: %.3fs, %s queries, %s bytes, %s items',
+            '  ' * depth, name, record.duration, record.queries,
+            record.bytes, record.items)
+    if 'snapshot' in sinks or 'file' in sinks:
+        key = (record.name, record.method)
+        with _lock:
+            counter = _counters.setdefault(key, [0, 0., 0, 0, 0])
+            counter[0] += 1
+            counter[1] += record.duration
+            counter[2] += record.queries
+            counter[3] += record.bytes
+            counter[4] += record.items
+        # the file is written once the outermost phase ends
+        if 'file' in sinks and not depth:
+            _write_metrics()
+
+
+def snapshot():
+    'Return the aggregated measures of the phases'
+    with _lock:
+        counters = sorted(_counters.items(),
+            key=lambda i: (i[0][0], i[0][1] or ''))
+        return [{
+                'name': name,
+                'method': method,
+                'count': count,
+                'duration': duration,
+                'queries': queries,
+                'bytes': bytes_,
+                'items': items,
+                } for (name, method), (count, duration, queries, bytes_, items)
+            in counters]
+
+
+def reset():
+    'Reset the aggregated measures'
+    with _lock:
+        _counters.clear()
+
+
+def _write_metrics():
+    lines = []
+    for counter in snapshot():
+        labels = 'phase="%s"' % counter['name']
+        if counter['method']:
+            labels += ',method="%s"' % counter['method']
+        for metric, key in [
+                ('count', 'count'),
+                ('seconds_total', 'duration'),
+                ('queries_total', 'queries'),
+                ('bytes_total', 'bytes'),
+                ('items_total', 'items'),
+                ]:
+            lines.append('carrier_send_shipments_phase_%s{%s} %s' % (
+                    metric, labels, counter[key]))
+    directory = os.path.dirname(os.path.abspath(metrics_file))
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                delete=False) as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(fp.name, metrics_file)
+    except OSError:
+        logger.warning('Could not write metrics file %s', metrics_file,
+            exc_info=True)
+
+
+def labels_size(labels):
+    'Return the byte size of the labels as paths or (name, data)'
+    size = 0
+    for label in labels:
+        if isinstance(label, str):
+            try:
+                size += os.path.getsize(label)
+            except OSError:
+                pass
+        elif isinstance(label, (tuple, list)):
+            size += len(label[1] or b'')
+        elif label:
+            size += len(label)
+    return size
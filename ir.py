@@ -0,0 +1,82 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['ActionReport', 'Cron']
+
+
+class ActionReport(metaclass=PoolMeta):
+    __name__ = 'ir.action.report'
+    _carrier_label_cache = Cache(
+        'carrier_send_shipments.action_report', context=False)
+
+    @classmethod
+    def get_carrier_label_action(cls, action_id=None, report_name=None):
+        '''Return a dictionary with the id, report_name, name and
+        direct_print of the carrier label report action'''
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+
+        key = (action_id, report_name, Transaction().language)
+        values = cls._carrier_label_cache.get(key)
+        if values is not None:
+            return values
+
+        if action_id is None:
+            if report_name is None:
+                action_id = ModelData.get_id(
+                    'carrier_send_shipments', 'report_label')
+            else:
+                action_reports = cls.search([
+                        ('report_name', '=', report_name),
+                        ], limit=1)
+                assert action_reports, '%s not found' % report_name
+                action_id = action_reports[0].id
+        action_report = cls(action_id)
+        values = {
+            'id': action_report.id,
+            'report_name': action_report.report_name,
+            'name': action_report.name,
+            'direct_print': action_report.direct_print,
+            }
+        cls._carrier_label_cache.set(key, values)
+        return values
+
+    @classmethod
+    def create(cls, vlist):
+        cls._carrier_label_cache.clear()
+        return super(ActionReport, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._carrier_label_cache.clear()
+        super(ActionReport, cls).write(*args)
+
+    @classmethod
+    def delete(cls, reports):
+        cls._carrier_label_cache.clear()
+        super(ActionReport, cls).delete(reports)
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('stock.shipment.out|deduplicate_carrier_label_attachments',
+                    "Deduplicate Carrier Label Attachments"),
+                ('carrier.send.attempt|purge', "Purge Carrier Send Attempts"),
+                ('stock.shipment.out|carrier_auto_send',
+                    "Send Shipments to Carriers"),
+                ('stock.shipment.out|compress_carrier_labels',
+                    "Compress Carrier Labels"),
+                ('stock.shipment.out|migrate_carrier_labels',
+                    "Move Carrier Labels to the Configured Storage"),
+                ('stock.shipment.out|reset_carrier_send_state',
+                    "Reset Stale Carrier Send States"),
+                ])
@@ -0,0 +1,258 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from datetime import datetime
+
+from trytond.config import config
+from trytond.model import fields
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+__all__ = ['label_name', 'read_label', 'guess_extension', 'merge_labels',
+    'bundle_labels', 'compress_label', 'decompress_label', 'LabelBinary']
+
+# Formats which are already compressed and are not worth to compress again
+COMPRESSED_EXTENSIONS = {
+    '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.zip', '.gz', '.tgz',
+    }
+# Formats of thermal printers which can be concatenated in a single stream
+TEXT_EXTENSIONS = {'.zpl', '.epl', '.txt'}
+ARCHIVES = {'tgz', 'zip'}
+MAGIC_NUMBERS = [
+    (b'%PDF', '.pdf'),
+    (b'\x89PNG', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'GIF8', '.gif'),
+    (b'^XA', '.zpl'),
+    ]
+label_archive = config.get('carrier_send_shipments', 'label_archive',
+    default='tgz')
+spool_size = config.getint('carrier_send_shipments', 'label_spool_size',
+    default=10 * 1024 * 1024)
+label_compress = config.getboolean('carrier_send_shipments', 'label_compress',
+    default=False)
+# Prefix of the compressed labels which can not start a label format
+COMPRESSED_MARKER = b'\x00LBLZ\x01'
+
+
+def label_name(label):
+    '''Return the file name of a label
+
+    A label is the path of a file or a tuple with the file name and the data.
+    '''
+    if isinstance(label, str):
+        return os.path.basename(label)
+    return label[0]
+
+
+def read_label(label):
+    'Return the data of a label'
+    if isinstance(label, str):
+        with open(label, 'rb') as fp:
+            return fp.read()
+    return bytes(label[1])
+
+
+def guess_extension(data):
+    'Return the extension of the label data from its content'
+    for magic, extension in MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return extension
+    return ''
+
+
+def _is_compressed(name):
+    return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def _write_tar(fp, labels):
+    # gzip does not reduce the size of compressed formats
+    if all(_is_compressed(label_name(label)) for label in labels):
+        mode, extension = 'w', 'tar'
+    else:
+        mode, extension = 'w:gz', 'tgz'
+    with tarfile.open(fileobj=fp, mode=mode) as tar:
+        for label in labels:
+            name = label_name(label)
+            if isinstance(label, str):
+                tar.add(label, arcname=name)
+            else:
+                data = bytes(label[1])
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = int(datetime.now().timestamp())
+                tar.addfile(info, io.BytesIO(data))
+    return extension
+
+
+def _write_zip(fp, labels):
+    with zipfile.ZipFile(fp, 'w') as zip_:
+        for label in labels:
+            name = label_name(label)
+            if _is_compressed(name):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            if isinstance(label, str):
+                zip_.write(label, name, compress_type=compress_type)
+            else:
+                zip_.writestr(name, bytes(label[1]),
+                    compress_type=compress_type)
+    return 'zip'
+
+
+def _merge_pdf(labels):
+    writer = PdfWriter()
+    for label in labels:
+        if isinstance(label, str):
+            writer.append(label)
+        else:
+            writer.append(io.BytesIO(bytes(label[1])))
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as fp:
+        writer.write(fp)
+        writer.close()
+        fp.seek(0)
+        return fp.read()
+
+
+def _merge_text(labels):
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as fp:
+        for label in labels:
+            if isinstance(label, str):
+                with open(label, 'rb') as label_fp:
+                    shutil.copyfileobj(label_fp, fp)
+            else:
+                fp.write(bytes(label[1]))
+        fp.seek(0)
+        return fp.read()
+
+
+def merge_labels(labels):
+    '''Merge the labels of the same format into a single printable document
+
+    PDF labels are merged into a multi-page PDF (when pypdf is installed) and
+    ZPL/EPL labels are concatenated into a single stream, keeping the order
+    of the labels. Labels of other formats are returned unchanged.
+    '''
+    formats = {}
+    items = []
+    for label in labels:
+        extension = os.path.splitext(label_name(label))[1].lower()
+        if ((extension == '.pdf' and PdfWriter)
+                or extension in TEXT_EXTENSIONS):
+            if extension not in formats:
+                formats[extension] = []
+                items.append((extension, formats[extension]))
+            formats[extension].append(label)
+        else:
+            items.append((extension, label))
+
+    merged = []
+    for extension, item in items:
+        if not isinstance(item, list):
+            merged.append(item)
+        elif len(item) == 1:
+            merged.append(item[0])
+        elif extension == '.pdf':
+            merged.append(('labels.pdf', _merge_pdf(item)))
+        else:
+            merged.append(('labels%s' % extension, _merge_text(item)))
+    return merged
+
+
+def bundle_labels(labels, prefix, archive=None):
+    '''Return the data and the file name to download the labels
+
+    A single label is returned as is and several labels are streamed into a
+    spooled archive of type "archive" (tgz or zip, by default the
+    label_archive option). With the "merge" type, the labels of the same
+    format are merged first into a single document with merge_labels.
+    '''
+    if not labels:
+        return None, None
+
+    archive = archive or label_archive
+    if archive == 'merge' and len(labels) > 1:
+        labels = merge_labels(labels)
+        if len(labels) == 1:
+            label, = labels
+            extension = os.path.splitext(label_name(label))[1]
+            file_name = '%s-%s%s' % (
+                prefix, datetime.now().strftime('%Y%m%d%H%M%S'), extension)
+            return fields.Binary.cast(read_label(label)), file_name
+    if len(labels) == 1:
+        label, = labels
+        return fields.Binary.cast(read_label(label)), label_name(label)
+
+    if archive not in ARCHIVES:
+        archive = 'tgz'
+    with tempfile.SpooledTemporaryFile(max_size=spool_size) as fp:
+        if archive == 'zip':
+            extension = _write_zip(fp, labels)
+        else:
+            extension = _write_tar(fp, labels)
+        fp.seek(0)
+        data = fp.read()
+    file_name = '%s-%s.%s' % (
+        prefix, datetime.now().strftime('%Y%m%d%H%M%S'), extension)
+    return fields.Binary.cast(data), file_name
+
+
+def compress_label(data):
+    '''Return the label data compressed with zlib and prefixed with the
+    marker when the label_compress option is enabled
+
+    The data is returned unchanged when it is already compressed or when
+    compressing it does not reduce its size.
+    '''
+    if not label_compress or not data:
+        return data
+    data = fields.Binary.cast(data)
+    if data.startswith(COMPRESSED_MARKER):
+        return data
+    compressed = COMPRESSED_MARKER + zlib.compress(data)
+    if len(compressed) < len(data):
+        return compressed
+    return data
+
+
+def decompress_label(data):
+    'Return the label data without compression'
+    if data and bytes(data[:len(COMPRESSED_MARKER)]) == COMPRESSED_MARKER:
+        return zlib.decompress(bytes(data[len(COMPRESSED_MARKER):]))
+    return data
+
+
+class LabelBinary(fields.Binary):
+    '''Binary field which stores the labels compressed with compress_label
+
+    The values stored without the marker are read unchanged.
+    '''
+
+    def get(self, ids, model, name, values=None):
+        result = super().get(ids, model, name, values=values)
+        for id_, value in result.items():
+            if isinstance(value, bytes):
+                result[id_] = decompress_label(value)
+        return result
+
+    def get_stored(self, ids, model, name, values=None):
+        'Return the values as they are stored'
+        return super().get(ids, model, name, values=values)
+
+    def set(self, Model, name, ids, value, *args):
+        args = iter((ids, value) + args)
+        values = []
+        for ids, value in zip(args, args):
+            values.extend((ids, compress_label(value)))
+        super().set(Model, name, *values)
@@ -1,13 +1,25 @@
 # This file is part of the carrier_send_shipments module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from datetime import datetime, time
+import os
+import tempfile
+from datetime import datetime, time, timedelta
 from dateutil.relativedelta import relativedelta
+from trytond.config import config
 from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import slugify
 from trytond.wizard import Button, StateTransition, StateView, Wizard
 
+from . import instrument
+from .label import bundle_labels
+
 __all__ = ['CarrierManifestStart', 'CarrierEnterManifest', 'CarrierManifest']
 
+_MANIFEST_ATTACHMENT_PREFIX = 'carrier-manifest-'
+manifest_chunk_days = config.getint('carrier_send_shipments',
+    'manifest_chunk_days', default=0)
+
 
 class CarrierManifestStart(ModelView):
     'Carrier Manifest Start'
@@ -59,10 +71,92 @@ class CarrierManifest(Wizard):
         from_date = self.start.from_date
         to_date = self.start.to_date
 
-        get_manifest = getattr(self, 'get_manifest_' + api.method)
-        manifest_file = get_manifest(api, from_date, to_date) #return a tuple
+        with instrument.phase('manifest', api.method) as record, \
+                tempfile.TemporaryDirectory() as directory:
+            parts = self.get_manifest_parts(api, from_date, to_date, directory)
+            manifest, file_name = bundle_labels(parts,
+                slugify('%s-manifest' % api.method), archive='merge')
+            if record and manifest:
+                record.add(bytes=len(manifest), items=len(parts))
 
-        self.result.manifest = bytearray(manifest_file[0]) if manifest_file else None
-        self.result.file_name = manifest_file[1] if manifest_file else None
+        self.result.manifest = manifest
+        self.result.file_name = file_name
 
         return 'result'
+
+    @staticmethod
+    def manifest_chunks(from_date, to_date, days):
+        '''Return the list of periods of the range split at the midnight of
+        every "days" days'''
+        if not days or to_date - from_date <= timedelta(days=days):
+            return [(from_date, to_date)]
+        chunks = []
+        start = from_date
+        while start < to_date:
+            end = min(to_date,
+                datetime.combine(start.date(), time(0))
+                + timedelta(days=days))
+            chunks.append((start, end))
+            start = end
+        return chunks
+
+    def get_manifest_parts(self, api, from_date, to_date, directory):
+        '''Return the manifests of the range split in chunks of the
+        manifest_chunk_days option
+
+        Each chunk is written to a file of the directory. The manifests of
+        the chunks which ended before today are stored as attachments of the
+        carrier API and they are not requested again.
+        '''
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        get_manifest = getattr(self, 'get_manifest_' + api.method)
+        chunks = self.manifest_chunks(from_date, to_date, manifest_chunk_days)
+        today = datetime.combine(datetime.now().date(), time(0))
+
+        def cache_name(start, end):
+            return '%s%s-%s-%s' % (_MANIFEST_ATTACHMENT_PREFIX, api.method,
+                start.strftime('%Y%m%d%H%M%S'), end.strftime('%Y%m%d%H%M%S'))
+
+        cached = {}
+        names = [cache_name(s, e) for s, e in chunks if e <= today]
+        if names:
+            for attachment in Attachment.search([
+                        ('resource', '=', str(api)),
+                        ('name', 'in', names),
+                        ]):
+                cached[attachment.name] = attachment
+
+        parts = []
+        to_save = []
+        for start, end in chunks:
+            name = cache_name(start, end)
+            if name in cached:
+                attachment = cached[name]
+                parts.append((attachment.description, attachment.data))
+                continue
+            with instrument.phase('manifest.chunk', api.method):
+                manifest_file = get_manifest(api, start, end) #return a tuple
+            if not manifest_file or not manifest_file[0]:
+                continue
+            data = bytes(manifest_file[0])
+            file_name = manifest_file[1] or api.method
+            if len(chunks) > 1:
+                root, extension = os.path.splitext(file_name)
+                file_name = '%s-%s%s' % (
+                    root, start.strftime('%Y%m%d'), extension)
+            if end <= today:
+                to_save.append(Attachment(
+                        name=name,
+                        description=file_name,
+                        type='data',
+                        data=fields.Binary.cast(data),
+                        resource=api))
+            path = os.path.join(directory, file_name)
+            with open(path, 'wb') as fp:
+                fp.write(data)
+            parts.append(path)
+        if to_save:
+            Attachment.save(to_save)
+        return parts
@@ -0,0 +1,107 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .carrier import CACHE_PREFIX
+from .tools import unaccent, unspaces
+
+__all__ = ['Address', 'Country', 'Subdivision']
+
+
+class Address(metaclass=PoolMeta):
+    __name__ = 'party.address'
+    _carrier_address_cache = Cache(CACHE_PREFIX + 'carrier_address',
+        context=False)
+
+    def get_carrier_address(self):
+        'Return the normalized values of the address for the carriers'
+        return self.get_carrier_addresses([self])[self.id]
+
+    @classmethod
+    def get_carrier_addresses(cls, addresses):
+        '''Return a dictionary with the normalized values of each address
+        for the carriers
+
+        The values are cached by address, last modification of the address
+        and of its party and language so they are reused by all the shipments
+        to the same address. The size of
+        the cache is set with the "carrier_send_shipments.carrier_address"
+        option of the [cache] section.
+        '''
+        language = Transaction().language
+        result = {}
+        keys = {}
+        ids = list({a.id for a in addresses})
+        for sub_ids in grouped_slice(ids):
+            values = cls.read(list(sub_ids), ['write_date', 'create_date',
+                    'party.write_date', 'party.create_date'])
+            for value in values:
+                party = value.get('party.') or {}
+                key = (value['id'],
+                    value['write_date'] or value['create_date'],
+                    party.get('write_date') or party.get('create_date'),
+                    language)
+                record = cls._carrier_address_cache.get(key)
+                if record is None:
+                    keys[value['id']] = key
+                else:
+                    result[value['id']] = record
+        for address in cls.browse(list(keys)):
+            record = address._get_carrier_address()
+            cls._carrier_address_cache.set(keys[address.id], record)
+            result[address.id] = record
+        return result
+
+    def _get_carrier_address(self):
+        ShipmentOut = Pool().get('stock.shipment.out')
+
+        party_name = self.party_name or (
+            self.party.rec_name if self.party else None)
+        comment = getattr(self, 'comment_shipment', None)
+        if comment:
+            comment = ShipmentOut._comment2txt(comment)
+        return {
+            'name': unaccent(party_name),
+            'street': unaccent(self.street_single_line),
+            'postal_code': unspaces(self.postal_code),
+            'city': unaccent(self.city),
+            'subdivision': unaccent(
+                self.subdivision.name if self.subdivision else None),
+            'subdivision_code': (
+                self.subdivision.code if self.subdivision else None),
+            'country': unaccent(self.country.name if self.country else None),
+            'country_code': self.country.code if self.country else None,
+            'comment': unaccent(comment),
+            }
+
+
+class Country(metaclass=PoolMeta):
+    __name__ = 'country.country'
+
+    @classmethod
+    def write(cls, *args):
+        Address._carrier_address_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, countries):
+        Address._carrier_address_cache.clear()
+        super().delete(countries)
+
+
+class Subdivision(metaclass=PoolMeta):
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def write(cls, *args):
+        Address._carrier_address_cache.clear()
+        super().write(*args)
+
+    @classmethod
+    def delete(cls, subdivisions):
+        Address._carrier_address_cache.clear()
+        super().delete(subdivisions)
@@ -0,0 +1,118 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+__all__ = ['carrier_session', 'close_sessions']
+
+pool_size = config.getint('carrier_send_shipments', 'http_pool_size',
+    default=10)
+idle_timeout = config.getfloat('carrier_send_shipments', 'http_idle_timeout',
+    default=300)
+default_timeout = config.getfloat('carrier_send_shipments', 'http_timeout',
+    default=30)
+
+if requests:
+    class _Session(requests.Session):
+        'Session with a default timeout'
+
+        def __init__(self, timeout):
+            super().__init__()
+            self.timeout = timeout
+
+        def request(self, method, url, **kwargs):
+            kwargs.setdefault('timeout', self.timeout)
+            return super().request(method, url, **kwargs)
+
+
+class _Registry(object):
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        # The connections are shared with the parent process so they are
+        # dropped without being closed
+        self.pid = os.getpid()
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def borrow(self, key, timeout):
+        if self.pid != os.getpid():
+            self.reset()
+        with self.lock:
+            self._evict(time.monotonic())
+            if key not in self.sessions:
+                session = _Session(timeout)
+                adapter = HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[key] = [session, None, 0]
+            entry = self.sessions[key]
+            entry[0].timeout = timeout
+            entry[2] += 1
+            return entry[0]
+
+    def release(self, key):
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+
+    def _evict(self, now):
+        for key, (session, last_used, borrowed) in list(
+                self.sessions.items()):
+            if not borrowed and now - last_used > idle_timeout:
+                del self.sessions[key]
+                session.close()
+
+    def close(self):
+        with self.lock:
+            for session, _, _ in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+_registry = _Registry()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_registry.reset)
+
+
+@contextmanager
+def carrier_session(api):
+    '''Borrow the HTTP session of the carrier API
+
+    The session keeps the connections alive between the calls of the
+    process. Its default timeout is the timeout of the API or the
+    http_timeout option.
+    '''
+    if not requests:
+        raise ImportError('requests is required to use carrier sessions')
+    key = (Transaction().database.name, api.id)
+    timeout = getattr(api, 'timeout', None) or default_timeout
+    session = _registry.borrow(key, timeout)
+    try:
+        yield session
+    finally:
+        _registry.release(key)
+
+
+def close_sessions():
+    'Close all the HTTP sessions of the process'
+    _registry.close()
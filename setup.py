@@ -114,6 +114,10 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'merge': ['pypdf'],
+        'http': ['requests'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
@@ -1,8 +1,10 @@
 # This file is part of the carrier_send_shipments module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from datetime import datetime
-from trytond.model import ModelView, fields
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from trytond.model import Index, ModelView, fields
 from trytond.wizard import (Wizard, StateTransition, StateView, Button,
     StateAction)
 from trytond.i18n import gettext
@@ -12,14 +14,28 @@ from trytond.transaction import Transaction
 from trytond.report import Report
 from trytond.pyson import Bool, Eval, Not, Equal
 from trytond.config import config
-from trytond.tools import slugify
+from trytond.filestore import filestore
+from trytond.tools import slugify, grouped_slice, reduce_ids
 from trytond.rpc import RPC
+from sql import Column, Null
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp
+from sql.operators import Like
+import hashlib
 import logging
-import tarfile
-import tempfile
+import os
+import re
+import time
+
+from .label import (COMPRESSED_MARKER, LabelBinary, bundle_labels,
+    guess_extension, label_compress, label_name, read_label)
+from .throttle import get_throttle
+from . import instrument
+from .tools import postal_code_index
 
 
 _SHIPMENT_STATES = ['packed', 'done']
+_LABEL_ATTACHMENT_PREFIX = 'carrier-label-'
 logger = logging.getLogger(__name__)
 
 if config.getboolean('carrier_send_shipments', 'filestore', default=False):
@@ -29,17 +45,33 @@ if config.getboolean('carrier_send_shipments', 'filestore', default=False):
 else:
     file_id = None
     store_prefix = None
+send_batch_size = config.getint('carrier_send_shipments', 'batch_size',
+    default=50)
+send_workers = config.getint('carrier_send_shipments', 'send_workers',
+    default=1)
+send_background = config.getboolean('carrier_send_shipments',
+    'send_background', default=False)
+label_migration_batch_size = config.getint('carrier_send_shipments',
+    'label_migration_batch_size', default=100)
+label_max_age = config.getfloat('carrier_send_shipments', 'label_max_age',
+    default=0)
+auto_send_batch_size = config.getint('carrier_send_shipments',
+    'auto_send_batch_size', default=send_batch_size)
+auto_send_max_runtime = config.getint('carrier_send_shipments',
+    'auto_send_max_runtime', default=0)
+send_state_timeout = config.getint('carrier_send_shipments',
+    'send_state_timeout', default=60)
 
 
 class ShipmentOut(metaclass=PoolMeta):
     __name__ = 'stock.shipment.out'
-    phone = fields.Function(fields.Char('Phone'), 'get_mechanism')
-    mobile = fields.Function(fields.Char('Mobile'), 'get_mechanism')
-    fax = fields.Function(fields.Char('Fax'), 'get_mechanism')
-    email = fields.Function(fields.Char('E-Mail'), 'get_mechanism')
+    phone = fields.Function(fields.Char('Phone'), 'get_mechanisms')
+    mobile = fields.Function(fields.Char('Mobile'), 'get_mechanisms')
+    fax = fields.Function(fields.Char('Fax'), 'get_mechanisms')
+    email = fields.Function(fields.Char('E-Mail'), 'get_mechanisms')
     carrier_service_domain = fields.Function(fields.One2Many(
             'carrier.api.service', None, 'Carrier Domain'),
-        'on_change_with_carrier_service_domain',
+        'get_carrier_service_domain',
         setter='set_carrier_service_domain')
     carrier_service = fields.Many2One('carrier.api.service',
         'Carrier API Service',
@@ -62,16 +94,34 @@ class ShipmentOut(metaclass=PoolMeta):
         help='Picking is already printed')
     carrier_weight = fields.Function(fields.Float('Carrier Weight',
         digits='weight_uom',
-        depends=['weight_uom']), 'on_change_with_carrier_weight')
+        depends=['weight_uom']), 'get_carrier_weights')
     carrier_weight_uom = fields.Function(fields.Many2One('product.uom',
-        'Carrier Weight UOM'), 'on_change_with_carrier_weight_uom')
+        'Carrier Weight UOM'), 'get_carrier_weights')
     carrier_send_employee = fields.Many2One('company.employee',
         'Carrier Send Employee', readonly=True)
     carrier_send_date = fields.DateTime('Carrier Send Date', readonly=True)
-    carrier_tracking_label = fields.Binary('Carrier Tracking Label',
+    carrier_tracking_label = LabelBinary('Carrier Tracking Label',
         readonly=True, file_id=file_id, store_prefix=store_prefix)
     carrier_tracking_label_id = fields.Char('Carrier Tracking Label ID',
         readonly=True)
+    carrier_send_state = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('sending', 'Sending'),
+            ('sent', 'Sent'),
+            ('failed', 'Failed'),
+            ], 'Carrier Send State', readonly=True,
+        states={
+            'invisible': ~Eval('carrier'),
+            },
+        help='The state of the background sending to the carrier API')
+    carrier_pending_send = fields.Function(fields.Boolean('Pending to Send',
+            help='The shipment has not been sent to the carrier API'),
+        'get_carrier_pending', searcher='search_carrier_pending')
+    carrier_pending_print = fields.Function(fields.Boolean('Pending to Print',
+            help='The label of the shipment sent to the carrier API has not '
+            'been printed'),
+        'get_carrier_pending', searcher='search_carrier_pending')
 
     @classmethod
     def __setup__(cls):
@@ -90,6 +140,22 @@ class ShipmentOut(metaclass=PoolMeta):
                         (Eval('carrier_printed')) | Not(Bool(Eval('carrier'))),
                     },
                 })
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.carrier, Index.Equality()),
+                    where=cls._carrier_pending_where(
+                        t, 'carrier_pending_send')),
+                Index(t, (t.carrier, Index.Equality()),
+                    where=cls._carrier_pending_where(
+                        t, 'carrier_pending_print')),
+                Index(t,
+                    (t.carrier, Index.Equality()),
+                    (t.carrier_send_date, Index.Range()),
+                    where=t.carrier_send_date != Null),
+                Index(t,
+                    (t.carrier_send_state, Index.Equality(cardinality='low')),
+                    where=t.carrier_send_state.in_(['queued', 'sending'])),
+                })
 
     @classmethod
     def __register__(cls, module_name):
@@ -114,20 +180,27 @@ class ShipmentOut(metaclass=PoolMeta):
 
         super(ShipmentOut, cls).__register__(module_name)
 
-    def _comment2txt(self, comment):
+    @staticmethod
+    def _comment2txt(comment):
         return comment.replace('\n', '. ').replace('\r', '')
 
     @fields.depends('carrier')
     def on_change_with_carrier_service_domain(self, name=None):
-        ApiCarrier = Pool().get('carrier.api-carrier.carrier')
+        API = Pool().get('carrier.api')
         carrier_api_services = []
         if self.carrier:
-            api_carriers = ApiCarrier.search([
-                    ('carrier', '=', self.carrier.id)])
-            carrier_api_services = [service.id for api_carrier in api_carriers
-                for service in api_carrier.api.services]
+            carrier_api_services = API.get_carrier_services(
+                [self.carrier.id])[self.carrier.id]
         return carrier_api_services
 
+    @classmethod
+    def get_carrier_service_domain(cls, shipments, name):
+        API = Pool().get('carrier.api')
+        services = API.get_carrier_services(
+            {s.carrier.id for s in shipments if s.carrier})
+        return {s.id: services[s.carrier.id] if s.carrier else []
+            for s in shipments}
+
     @classmethod
     def set_carrier_service_domain(cls, shipments, name, value):
         # maybe is a bug client since 5.6
@@ -161,6 +234,92 @@ class ShipmentOut(metaclass=PoolMeta):
             api = self.carrier.apis[0]
             return api.weight_api_unit.id if api.weight_api_unit else None
 
+    @classmethod
+    def get_carrier_weights(cls, shipments, names):
+        '''Return the carrier weight and its unit of the shipments
+
+        It gives the same result as the on_change_with methods, but the API
+        of each carrier is read once and the conversion of each pair of
+        units is prepared once.
+        '''
+        result = {name: {} for name in names}
+        apis = {}
+        conversions = {}
+        for shipment in shipments:
+            api = None
+            if shipment.carrier:
+                carrier_id = shipment.carrier.id
+                if carrier_id not in apis:
+                    apis[carrier_id] = (shipment.carrier.apis[0]
+                        if shipment.carrier.apis else None)
+                api = apis[carrier_id]
+            if 'carrier_weight_uom' in names:
+                result['carrier_weight_uom'][shipment.id] = (
+                    api.weight_api_unit.id
+                    if api and api.weight_api_unit else None)
+            if 'carrier_weight' in names:
+                result['carrier_weight'][shipment.id] = (
+                    shipment._get_carrier_weight(api, conversions))
+        return result
+
+    def _get_carrier_weight(self, api, conversions):
+        if 'manual_weight' not in self._fields:
+            return 1.0
+
+        weight = self.manual_weight or self.weight
+        if weight == 0 or weight == 0.0:
+            weight = 1.0
+
+        if api and api.weight_api_unit:
+            if self.weight_uom:
+                weight = self._convert_carrier_weight(
+                    self.weight_uom, weight, api.weight_api_unit,
+                    conversions)
+            elif api.weight_unit:
+                weight = self._convert_carrier_weight(
+                    api.weight_unit, weight, api.weight_api_unit,
+                    conversions)
+        return weight
+
+    @staticmethod
+    def _convert_carrier_weight(from_uom, qty, to_uom, conversions):
+        '''Convert the quantity like Uom.compute_qty with the operands of the
+        pair of units stored in conversions'''
+        Uom = Pool().get('product.uom')
+
+        if not qty:
+            return qty
+        key = (from_uom.id, to_uom.id)
+        if key not in conversions:
+            if from_uom.category.id != to_uom.category.id:
+                conversions[key] = None
+            elif from_uom == to_uom:
+                conversions[key] = ()
+            else:
+                conversions[key] = (
+                    from_uom.accurate_field,
+                    getattr(from_uom, from_uom.accurate_field),
+                    to_uom.accurate_field,
+                    getattr(to_uom, to_uom.accurate_field),
+                    )
+        conversion = conversions[key]
+        if conversion is None:
+            # raise the same error
+            return Uom.compute_qty(from_uom, qty, to_uom)
+        if conversion:
+            from_field, from_value, to_field, to_value = conversion
+            if from_field == 'factor':
+                amount = qty * from_value
+            else:
+                amount = qty / from_value
+            if to_field == 'factor':
+                amount = amount / to_value
+            else:
+                amount = amount * to_value
+        else:
+            amount = qty
+        return to_uom.round(amount)
+
     def on_change_customer(self):
         super(ShipmentOut, self).on_change_customer()
 
@@ -211,44 +370,119 @@ class ShipmentOut(metaclass=PoolMeta):
         default['carrier_printed'] = None
         default['carrier_tracking_label'] = None
         default['carrier_tracking_label_id'] = None
+        default['carrier_send_state'] = None
         return super(ShipmentOut, cls).copy(shipments, default=default)
 
+    @classmethod
+    def _carrier_pending_where(cls, table, name):
+        'Return the condition of the partial index of the pending queue'
+        where = table.state.in_(_SHIPMENT_STATES) & (table.carrier != Null)
+        if name == 'carrier_pending_send':
+            where &= table.carrier_tracking_ref == Null
+        else:
+            where &= ((table.carrier_tracking_ref != Null)
+                & ~Coalesce(table.carrier_printed, False))
+        return where
+
+    @classmethod
+    def _carrier_pending_query(cls, name):
+        pool = Pool()
+        ApiCarrier = pool.get('carrier.api-carrier.carrier')
+        table = cls.__table__()
+        api_carrier = ApiCarrier.__table__()
+
+        where = cls._carrier_pending_where(table, name)
+        if name == 'carrier_pending_send':
+            where &= table.carrier.in_(
+                api_carrier.select(api_carrier.carrier))
+        return table, where
+
+    @classmethod
+    def get_carrier_pending(cls, shipments, names):
+        cursor = Transaction().connection.cursor()
+
+        result = {}
+        for name in names:
+            result[name] = dict.fromkeys((s.id for s in shipments), False)
+            table, where = cls._carrier_pending_query(name)
+            for sub_ids in grouped_slice([s.id for s in shipments]):
+                cursor.execute(*table.select(table.id,
+                        where=where & reduce_ids(table.id, sub_ids)))
+                for shipment_id, in cursor:
+                    result[name][shipment_id] = True
+        return result
+
+    @classmethod
+    def search_carrier_pending(cls, name, clause):
+        _, operator, value = clause
+        table, where = cls._carrier_pending_query(name)
+        query = table.select(table.id, where=where)
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
+
     def get_mechanism(self, name):
+        return self.get_mechanisms([self], [name])[name][self.id]
+
+    @classmethod
+    def get_mechanisms(cls, shipments, names):
         pool = Pool()
         ContactMechanism = pool.get('party.contact_mechanism')
 
-        value = None
-        if (hasattr(self.delivery_address, name) and
-                getattr(self.delivery_address, name)):
-            value = getattr(self.delivery_address, name)
-        if value:
-            return value
-
-        mechanisms = ContactMechanism.search([
-            ('party', '=', self.customer),
-            ('type', '=', name),
-            ('write_date', '!=', None),
-            ], order=[('write_date', 'DESC')], limit=1)
-        mechanism_write_date = (mechanisms[0] if mechanisms else None)
-
-        mechanisms = ContactMechanism.search([
-            ('party', '=', self.customer),
-            ('type', '=', name),
-            ], order=[('create_date', 'DESC')], limit=1)
-        mechanism_create_date = (mechanisms[0] if mechanisms else None)
-
-        mechanism_value = None
-        if mechanism_write_date and mechanism_create_date:
-            if (mechanism_write_date.write_date and (mechanism_write_date.write_date >
-                    mechanism_create_date.create_date)):
-                mechanism_value = mechanism_write_date.value
-            else:
-                mechanism_value = mechanism_create_date.value
-        elif mechanism_create_date and not mechanism_write_date:
-            mechanism_value = mechanism_create_date.value
-        elif not mechanism_create_date and mechanism_write_date:
-            mechanism_value = mechanism_write_date.value
-        return mechanism_value
+        result = {name: {s.id: None for s in shipments} for name in names}
+        party_ids = set()
+        for shipment in shipments:
+            for name in names:
+                value = getattr(shipment.delivery_address, name, None)
+                if value:
+                    result[name][shipment.id] = value
+                elif shipment.customer:
+                    party_ids.add(shipment.customer.id)
+        if not party_ids:
+            return result
+
+        # most recent mechanism by write date and by create date per party
+        last_write = {}
+        last_create = {}
+        for sub_ids in grouped_slice(list(party_ids)):
+            mechanisms = ContactMechanism.search([
+                    ('party', 'in', list(sub_ids)),
+                    ('type', 'in', names),
+                    ])
+            for mechanism in mechanisms:
+                key = (mechanism.party.id, mechanism.type)
+                if mechanism.write_date:
+                    current = last_write.get(key)
+                    if (not current or (mechanism.write_date, mechanism.id)
+                            > (current.write_date, current.id)):
+                        last_write[key] = mechanism
+                current = last_create.get(key)
+                if (not current or (mechanism.create_date, mechanism.id)
+                        > (current.create_date, current.id)):
+                    last_create[key] = mechanism
+
+        for shipment in shipments:
+            if not shipment.customer:
+                continue
+            for name in names:
+                if result[name][shipment.id]:
+                    continue
+                key = (shipment.customer.id, name)
+                mechanism_write_date = last_write.get(key)
+                mechanism_create_date = last_create.get(key)
+                mechanism_value = None
+                if mechanism_write_date and mechanism_create_date:
+                    if (mechanism_write_date.write_date
+                            > mechanism_create_date.create_date):
+                        mechanism_value = mechanism_write_date.value
+                    else:
+                        mechanism_value = mechanism_create_date.value
+                elif mechanism_create_date:
+                    mechanism_value = mechanism_create_date.value
+                elif mechanism_write_date:
+                    mechanism_value = mechanism_write_date.value
+                result[name][shipment.id] = mechanism_value
+        return result
 
     @staticmethod
     def get_carrier_employee():
@@ -267,53 +501,714 @@ class ShipmentOut(metaclass=PoolMeta):
     @classmethod
     def send_shipment_api(cls, shipment):
         '''Send Shipmemt to carrier API'''
+        return cls.send_shipments_api([shipment])
+
+    @classmethod
+    def send_shipments_api(cls, shipments):
+        '''Send Shipments to carrier API
+
+        Shipments are grouped by carrier API and each group is sent in
+        batches of "batch_size" shipments to the send_<method> of the API.
+        When "send_workers" is greater than 1, the batches are sent
+        concurrently.
+        '''
         pool = Pool()
-        Shipment = pool.get('stock.shipment.out')
         API = pool.get('carrier.api')
-        ModelData = pool.get('ir.model.data')
-        ActionReport = pool.get('ir.action.report')
 
-        if not shipment.carrier:
-            message = gettext('carrier_send_shipments.msg_not_carrier',
-                name=shipment.rec_name)
-            return [], [], [message]
+        references = []
+        labels = []
+        errors = []
 
-        apis = API.search([('carriers', 'in', [shipment.carrier.id])],
-            limit=1)
-        if not apis:
-            message = gettext('carrier_send_shipments.msg_not_carrier_api',
-                name=shipment.rec_name)
-            logger.warning(message)
-            return [], [], [message]
+        groups = {}
+        for shipment in shipments:
+            if not shipment.carrier:
+                message = gettext('carrier_send_shipments.msg_not_carrier',
+                    name=shipment.rec_name)
+                errors.append(message)
+                continue
 
-        api, = apis
+            api = API.get_carrier_api(shipment.carrier)
+            if not api:
+                message = gettext('carrier_send_shipments.msg_not_carrier_api',
+                    name=shipment.rec_name)
+                logger.warning(message)
+                errors.append(message)
+                continue
+
+            if (not shipment.delivery_address.street
+                    or not shipment.delivery_address.postal_code
+                    or not shipment.delivery_address.city
+                    or not shipment.delivery_address.country):
+                message = gettext(
+                    'carrier_send_shipments.msg_shipmnet_delivery_address',
+                    name=shipment.rec_name)
+                logger.warning(message)
+                errors.append(message)
+                continue
+
+            groups.setdefault(api.id, (api, []))[1].append(shipment)
+
+        for api, api_shipments in groups.values():
+            workers = cls.get_send_workers(api)
+            if workers > 1 and len(api_shipments) > 1:
+                refs, labs, errs = cls.send_shipments_concurrent(
+                    api, api_shipments, workers)
+                references += refs
+                labels += labs
+                errors += errs
+                continue
+            for sub_shipments in grouped_slice(api_shipments,
+                    send_batch_size):
+                refs, labs, errs = cls.send_shipments_batch(
+                    api, list(sub_shipments))
+                references += refs
+                labels += labs
+                errors += errs
+        return references, labels, errors
+
+    @classmethod
+    def send_shipments_api_background(cls, shipments):
+        'Queue a task per carrier API to send the shipments'
+        pool = Pool()
+        API = pool.get('carrier.api')
+
+        groups = {}
+        for shipment in shipments:
+            api = API.get_carrier_api(shipment.carrier)
+            groups.setdefault(api.id if api else None, []).append(shipment)
+
+        cls.write(shipments, {'carrier_send_state': 'queued'})
+        with Transaction().set_context(queue_name='carrier_send_shipments'):
+            for api_shipments in groups.values():
+                cls.__queue__.send_shipments_api_task(api_shipments)
+
+    @classmethod
+    def send_shipments_api_task(cls, shipments):
+        '''Send shipments to the carrier API from a queue task
+
+        The send state is written in its own transactions to make the
+        progress visible while the shipments are sent. Only the shipments
+        claimed by claim_carrier_send are sent.
+        '''
+        transaction = Transaction()
+        ids = [s.id for s in shipments]
+
+        try:
+            with transaction.new_transaction():
+                ids = cls.claim_carrier_send(cls.browse(ids))
+        except Exception:
+            logger.warning('Could not claim shipments %s to send to carrier',
+                ids, exc_info=True)
+            return
+        if not ids:
+            return
+        try:
+            with transaction.new_transaction():
+                references, labels, errors = cls.send_shipments_api(
+                    cls.browse(ids))
+                for error in errors:
+                    logger.warning(error)
+        except Exception:
+            logger.exception('Error sending shipments %s to carrier', ids)
+        # the concurrent workers commit the shipments they send in their own
+        # transactions, so the result is read in a transaction started after
+        with transaction.new_transaction():
+            cls.set_carrier_send_state(cls.browse(ids))
+
+    @classmethod
+    def _carrier_send_claim_where(cls, table):
+        'Return the condition of the shipments which can be claimed to send'
+        return ((table.carrier_tracking_ref == Null)
+            & ((table.carrier_send_state == Null)
+                | (table.carrier_send_state == 'queued')))
+
+    @classmethod
+    def claim_carrier_send(cls, shipments):
+        '''Mark as sending the shipments which are neither sent nor being sent
+        and return their ids
+
+        The rows are updated with a condition on their current values in the
+        transaction which read them, so the concurrent claims of a shipment
+        fail with a serialization error and a single sender gets it.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        where = cls._carrier_send_claim_where(table)
+        claimed = []
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids) & where))
+            sub_claimed = [i for i, in cursor]
+            if not sub_claimed:
+                continue
+            cursor.execute(*table.update(
+                    [table.carrier_send_state, table.write_uid,
+                        table.write_date],
+                    ['sending', transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(table.id, sub_claimed) & where))
+            if cursor.rowcount != len(sub_claimed):
+                raise RuntimeError('Shipments %s claimed concurrently'
+                    % sub_claimed)
+            claimed.extend(sub_claimed)
+        return claimed
+
+    @classmethod
+    def carrier_auto_send(cls):
+        '''Send the shipments pending to send to the carriers from the cron
+
+        The shipments of each carrier API are sent in batches of
+        "auto_send_batch_size" shipments, only inside the window of the API
+        and spread over the runs left until its cutoff time. The shipments
+        which do not pass the checks are skipped and the run stops once
+        "auto_send_max_runtime" seconds have elapsed.
+        '''
+        pool = Pool()
+        API = pool.get('carrier.api')
+
+        started = time.monotonic()
+        now = datetime.now()
+        interval = cls.get_auto_send_interval(now)
+
+        shipments = cls.search([
+                ('carrier_pending_send', '=', True),
+                ('carrier_send_state', '=', None),
+                ], order=[('id', 'ASC')])
+        groups = {}
+        for shipment in shipments:
+            api = API.get_carrier_api(shipment.carrier)
+            if api:
+                groups.setdefault(api.id, (api, []))[1].append(shipment)
+
+        for api, api_shipments in groups.values():
+            limit = cls.get_auto_send_limit(
+                api, len(api_shipments), now, interval)
+            to_send = []
+            for sub_shipments in grouped_slice(api_shipments):
+                if len(to_send) >= limit:
+                    break
+                sub_shipments = list(sub_shipments)
+                errors = cls.get_carrier_send_errors(sub_shipments)
+                for shipment in sub_shipments:
+                    if errors[shipment.id]:
+                        logger.info('Skip sending shipment %s: %s',
+                            shipment.rec_name, ' '.join(errors[shipment.id]))
+                    else:
+                        to_send.append(shipment)
+            for sub_shipments in grouped_slice(to_send[:limit],
+                    auto_send_batch_size):
+                if (auto_send_max_runtime
+                        and time.monotonic() - started
+                        >= auto_send_max_runtime):
+                    logger.info('Stop sending shipments after %s seconds',
+                        auto_send_max_runtime)
+                    return
+                cls.send_shipments_api_task(list(sub_shipments))
+
+    @classmethod
+    def get_auto_send_interval(cls, now):
+        'Return the shortest interval of the active auto-send crons or None'
+        Cron = Pool().get('ir.cron')
+        crons = Cron.search([
+                ('method', '=', 'stock.shipment.out|carrier_auto_send'),
+                ])
+        return min((now + relativedelta(**{
+                            c.interval_type: c.interval_number}) - now
+                for c in crons),
+            default=None)
+
+    @classmethod
+    def get_auto_send_times(cls, api):
+        '''Return the window as a (start, end) tuple and the cutoff time to
+        send the shipments of the API
+
+        They are set with the auto_send_window ("HH:MM-HH:MM") and
+        auto_send_cutoff ("HH:MM") options or with their variants suffixed
+        by the method of the API.
+        '''
+        def get(name):
+            return config.get('carrier_send_shipments',
+                '%s_%s' % (name, api.method),
+                default=config.get('carrier_send_shipments', name,
+                    default=None))
+
+        def parse(value):
+            return datetime.strptime(value.strip(), '%H:%M').time()
+
+        window = get('auto_send_window')
+        if window:
+            start, end = window.split('-')
+            window = parse(start), parse(end)
+        cutoff = get('auto_send_cutoff')
+        if cutoff:
+            cutoff = parse(cutoff)
+        return window or None, cutoff or None
+
+    @classmethod
+    def get_auto_send_limit(cls, api, pending, now, interval=None):
+        '''Return the number of pending shipments of the API to send in the
+        run at now
+
+        None is sent outside the window nor from the cutoff time. Before the
+        cutoff, the pending shipments are spread evenly over the runs left
+        according to the interval of the cron.
+        '''
+        window, cutoff = cls.get_auto_send_times(api)
+        if window:
+            start, end = window
+            current = now.time()
+            if start <= end:
+                inside = start <= current < end
+            else:
+                inside = current >= start or current < end
+            if not inside:
+                return 0
+        if cutoff:
+            cutoff = datetime.combine(now.date(), cutoff)
+            if now >= cutoff:
+                return 0
+            if interval:
+                runs = -((now - cutoff) // interval)
+                return -(-pending // runs)
+        return pending
+
+    @classmethod
+    def send_shipments_batch(cls, api, shipments):
+        'Send a batch of shipments of the same carrier API'
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
 
-        if (not shipment.delivery_address.street
-                or not shipment.delivery_address.postal_code
-                or not shipment.delivery_address.city
-                or not shipment.delivery_address.country):
+        rate_limiter, circuit_breaker = get_throttle(api)
+        if not circuit_breaker.allow():
             message = gettext(
-                'carrier_send_shipments.msg_shipmnet_delivery_address',
-                name=shipment.rec_name)
+                'carrier_send_shipments.msg_carrier_api_unavailable',
+                api=api.rec_name,
+                shipments=', '.join(s.rec_name for s in shipments))
             logger.warning(message)
+            now = datetime.now()
+            cls.log_send_attempts(api, shipments, now, now,
+                outcome='rejected', errors=[message])
+            cls.set_carrier_send_state(shipments)
             return [], [], [message]
 
         send_shipment = getattr(Shipment, 'send_%s' % api.method)
-        refs, labs, errs = send_shipment(api, [shipment])
-        if errs:
-            return refs, labs, errs
-
-        # call report
-        action_id = ModelData.get_id('carrier_send_shipments', 'report_label')
-        action_report = ActionReport(action_id)
-        Report = pool.get(action_report.report_name, type='report')
-        Report.execute([shipment], {
+        # the breaker may be half-open and waiting for this call as probe, so
+        # it must get the result whatever happens
+        succeeded = False
+        try:
+            rate_limiter.wait()
+            with instrument.phase('send.carrier', api.method) as record:
+                start = datetime.now()
+                try:
+                    refs, labs, errs = send_shipment(api, shipments)
+                except Exception as exception:
+                    # the transaction of the send is rolled back
+                    with Transaction().new_transaction():
+                        try:
+                            cls.log_send_attempts(api, shipments, start,
+                                datetime.now(), outcome='error',
+                                errors=[str(exception)])
+                        except Exception:
+                            logger.warning(
+                                'Could not log the send attempts',
+                                exc_info=True)
+                    raise
+                # the errors returned by the carrier are rejections of the
+                # shipments (address, service...) so only the exceptions
+                # count as failures
+                succeeded = True
+                circuit_breaker.success()
+                end = datetime.now()
+                if record:
+                    record.add(bytes=instrument.labels_size(labs),
+                        items=len(shipments))
+        finally:
+            if not succeeded:
+                circuit_breaker.failure()
+        cls.log_send_attempts(api, shipments, start, end, labels=labs,
+            errors=errs)
+        sent = cls.set_carrier_send_state(shipments)
+        # only print labels of the shipments sent to the carrier
+        with instrument.phase('send.label_report', api.method):
+            cls.execute_label_report(sent)
+        return refs, labs, errs
+
+    @classmethod
+    def get_carrier_send_stale_date(cls):
+        '''Return the date before which the queued and sending states are
+        stale or None if they never are'''
+        if send_state_timeout > 0:
+            return datetime.now() - timedelta(minutes=send_state_timeout)
+
+    @property
+    def carrier_send_state_stale(self):
+        "The shipment is queued or sending since before the timeout"
+        stale_date = self.get_carrier_send_stale_date()
+        return bool(stale_date
+            and self.carrier_send_state in {'queued', 'sending'}
+            and (self.write_date or self.create_date) < stale_date)
+
+    @classmethod
+    def reset_carrier_send_state(cls):
+        '''Set as failed the shipments queued or sending since before the
+        "send_state_timeout" minutes, for example when the worker stopped'''
+        stale_date = cls.get_carrier_send_stale_date()
+        if not stale_date:
+            return
+        shipments = cls.search([
+                ('carrier_send_state', 'in', ['queued', 'sending']),
+                ['OR',
+                    ('write_date', '<', stale_date),
+                    [
+                        ('write_date', '=', None),
+                        ('create_date', '<', stale_date),
+                        ],
+                    ],
+                ])
+        if shipments:
+            logger.warning('Reset the stale send state of shipments %s',
+                [s.id for s in shipments])
+            cls.set_carrier_send_state(shipments)
+
+    @classmethod
+    def set_carrier_send_state(cls, shipments):
+        '''Set the send state of the shipments to sent or failed depending on
+        their tracking reference and return the sent shipments'''
+        sent, failed = [], []
+        for shipment in cls.browse(shipments):
+            if shipment.carrier_tracking_ref:
+                if shipment.carrier_send_state != 'sent':
+                    sent.append(shipment)
+            elif shipment.carrier_send_state != 'failed':
+                failed.append(shipment)
+        to_write = []
+        if sent:
+            to_write.extend((sent, {'carrier_send_state': 'sent'}))
+        if failed:
+            to_write.extend((failed, {'carrier_send_state': 'failed'}))
+        if to_write:
+            cls.write(*to_write)
+        return [s for s in cls.browse(shipments) if s.carrier_tracking_ref]
+
+    @classmethod
+    def log_send_attempts(cls, api, shipments, start, end, labels=None,
+            errors=None, outcome=None):
+        '''Record the attempt to send each shipment to the carrier API
+
+        Without outcome, the shipments with a tracking reference are sent and
+        the others are failed with the errors which contain their number, not
+        as part of a longer one (OUT/1 in OUT/10), or all the errors.
+        '''
+        pool = Pool()
+        Attempt = pool.get('carrier.send.attempt')
+
+        ids = [s.id for s in shipments]
+        values = cls.read(ids, ['number', 'carrier_tracking_ref'])
+        sent = [v for v in values if v['carrier_tracking_ref']]
+        label_sizes = {}
+        if labels and len(labels) == len(sent):
+            label_sizes = {v['id']: instrument.labels_size([label])
+                for v, label in zip(sent, labels)}
+        errors = errors or []
+
+        attempts = []
+        for value in values:
+            if outcome:
+                shipment_outcome = outcome
+            elif value['carrier_tracking_ref']:
+                shipment_outcome = 'sent'
+            else:
+                shipment_outcome = 'failed'
+            error = None
+            if shipment_outcome != 'sent' and errors:
+                shipment_errors = []
+                if value['number']:
+                    number = re.compile(
+                        r'(?<!\w)%s(?!\w)' % re.escape(value['number']))
+                    shipment_errors = [e for e in errors if number.search(e)]
+                error = '\n'.join(shipment_errors or errors)
+            attempts.append({
+                    'shipment': value['id'],
+                    'api': api.id,
+                    'method': api.method,
+                    'start': start,
+                    'end': end,
+                    'duration': (end - start).total_seconds(),
+                    'batch_size': len(shipments),
+                    'outcome': shipment_outcome,
+                    'error': error,
+                    'label_size': label_sizes.get(value['id']),
+                    })
+        Attempt.log(attempts)
+
+    @classmethod
+    def get_send_workers(cls, api):
+        'Return the number of concurrent workers to send to the carrier API'
+        return config.getint('carrier_send_shipments',
+            'send_workers_%s' % api.method, default=send_workers)
+
+    @classmethod
+    def get_label_max_age(cls, api):
+        '''Return the maximum age of the stored label to print it without
+        calling the carrier API or None'''
+        hours = config.getfloat('carrier_send_shipments',
+            'label_max_age_%s' % api.method, default=label_max_age)
+        if hours:
+            return timedelta(hours=hours)
+
+    @classmethod
+    def send_shipments_concurrent(cls, api, shipments, workers):
+        '''Send shipments of the same carrier API with a pool of workers
+
+        Each batch is sent in its own transaction which is committed when
+        the batch has been sent.
+        '''
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = dict(transaction.context)
+
+        size = min(send_batch_size, -(-len(shipments) // workers))
+        batches = [[s.id for s in sub_shipments]
+            for sub_shipments in grouped_slice(shipments, size)]
+
+        references = []
+        labels = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(cls._send_shipments_worker,
+                    database_name, user, context, api.id, shipment_ids)
+                for shipment_ids in batches]
+            for shipment_ids, future in zip(batches, futures):
+                try:
+                    refs, labs, errs = future.result()
+                except Exception as exception:
+                    logger.exception('Error sending shipments %s to %s',
+                        shipment_ids, api.rec_name)
+                    errs = [gettext('carrier_send_shipments.msg_send_error',
+                            shipments=', '.join(s.rec_name
+                                for s in cls.browse(shipment_ids)),
+                            api=api.rec_name,
+                            error=str(exception))]
+                    refs, labs = [], []
+                references += refs
+                labels += labs
+                errors += errs
+        return references, labels, errors
+
+    @staticmethod
+    def _send_shipments_worker(database_name, user, context, api_id,
+            shipment_ids):
+        with Transaction().start(database_name, user, context=context):
+            pool = Pool()
+            Shipment = pool.get('stock.shipment.out')
+            API = pool.get('carrier.api')
+            return Shipment.send_shipments_batch(
+                API(api_id), Shipment.browse(shipment_ids))
+
+    @classmethod
+    def execute_label_report(cls, shipments):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+
+        if not shipments:
+            return
+
+        action_report = ActionReport.get_carrier_label_action()
+        Report = pool.get(action_report['report_name'], type='report')
+        ids = [s.id for s in shipments]
+        Report.execute(ids, {
             'model': 'stock.shipment.out',
-            'id': shipment.id,
-            'ids': [shipment.id],
-            'action_id': action_id,
+            'id': ids[0],
+            'ids': ids,
+            'action_id': action_report['id'],
+            # the report is only useful when it is sent to a printer
+            'discard_result': True,
             })
-        return refs, labs, errs
+
+    @staticmethod
+    def _label_attachment_name(name, data):
+        extension = os.path.splitext(name)[1]
+        return '%s%s%s' % (_LABEL_ATTACHMENT_PREFIX,
+            hashlib.sha256(data).hexdigest(), extension)
+
+    @classmethod
+    def attach_carrier_labels(cls, shipment_labels):
+        '''Attach the labels to the shipments
+
+        The name of the attachment is the hash of the label content so a label
+        which is already attached is not stored again.
+        '''
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        to_attach = {}
+        for shipment, label in shipment_labels:
+            data = read_label(label)
+            name = cls._label_attachment_name(label_name(label), data)
+            to_attach.setdefault((str(shipment), name), data)
+        if not to_attach:
+            return []
+
+        attachments = []
+        for sub_keys in grouped_slice(list(to_attach.keys())):
+            sub_keys = list(sub_keys)
+            attachments += Attachment.search([
+                    ('resource', 'in', list({r for r, _ in sub_keys})),
+                    ('name', 'in', list({n for _, n in sub_keys})),
+                    ])
+        for attachment in attachments:
+            to_attach.pop((str(attachment.resource), attachment.name), None)
+
+        to_save = [Attachment(
+                name=name,
+                type='data',
+                data=fields.Binary.cast(data),
+                resource=resource)
+            for (resource, name), data in to_attach.items()]
+        Attachment.save(to_save)
+        return attachments + to_save
+
+    @classmethod
+    def deduplicate_carrier_label_attachments(cls):
+        '''Remove the duplicated label attachments of the shipments
+
+        The first attachment of each content is renamed with the hash of the
+        content and the other copies are deleted. The attachments are
+        processed by slices which are committed.
+        '''
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        attachment = Attachment.__table__()
+
+        # labels attached by the print wizard are named with the print date
+        # or with the hash of the content
+        cursor.execute(*attachment.select(attachment.id,
+                where=Like(attachment.resource, cls.__name__ + ',%')
+                & (Like(attachment.name, '__/__/__ __:__:__')
+                    | Like(attachment.name, _LABEL_ATTACHMENT_PREFIX + '%')),
+                order_by=[attachment.resource, attachment.id]))
+        attachment_ids = [i for i, in cursor]
+
+        resource, digests = None, {}
+        for sub_ids in grouped_slice(attachment_ids):
+            to_rename, to_delete = [], []
+            for record in Attachment.browse(list(sub_ids)):
+                if str(record.resource) != resource:
+                    resource, digests = str(record.resource), {}
+                data = record.data or b''
+                digest = hashlib.sha256(data).hexdigest()
+                if digest in digests:
+                    to_delete.append(record)
+                    continue
+                digests[digest] = record.id
+                if not record.name.startswith(_LABEL_ATTACHMENT_PREFIX):
+                    record.name = '%s%s%s' % (_LABEL_ATTACHMENT_PREFIX,
+                        digest, guess_extension(data))
+                    to_rename.append(record)
+            Attachment.save(to_rename)
+            Attachment.delete(to_delete)
+            transaction.commit()
+
+    @classmethod
+    def compress_carrier_labels(cls):
+        '''Compress the labels of the shipments stored without compression
+
+        It does nothing when the label_compress option is disabled. The
+        shipments are processed by slices which are committed.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        name = 'carrier_tracking_label'
+        field = cls._fields[name]
+
+        if not label_compress:
+            return
+
+        if field.file_id:
+            column = Column(table, field.file_id)
+            where = (column != Null) & (column != '')
+        else:
+            column = Column(table, name)
+            where = column != Null
+        cursor.execute(*table.select(table.id, where=where,
+                order_by=[table.id]))
+        ids = [i for i, in cursor]
+
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.select(table.id, Column(table, name),
+                    where=reduce_ids(table.id, sub_ids)))
+            values = [{'id': i, name: v} for i, v in cursor]
+            stored = field.get_stored(sub_ids, cls, name, values=values)
+            to_write = []
+            for shipment_id, data in stored.items():
+                if data and not data.startswith(COMPRESSED_MARKER):
+                    to_write.extend(([shipment_id], data))
+            if to_write:
+                field.set(cls, name, *to_write)
+            transaction.commit()
+
+    @classmethod
+    def migrate_carrier_labels(cls, to=None, batch_size=None):
+        '''Move the labels of the shipments between the database and the
+        filestore
+
+        "to" is "filestore" or "database", by default the storage set by the
+        filestore option. The labels are moved as they are stored, by batches
+        of "batch_size" shipments which are committed, so the migration can
+        be stopped and run again to resume it.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        field = cls._fields['carrier_tracking_label']
+        column = table.carrier_tracking_label
+        column_id = table.carrier_tracking_label_id
+
+        if to is None:
+            to = 'filestore' if file_id else 'database'
+        assert to in {'filestore', 'database'}, to
+        batch_size = batch_size or label_migration_batch_size
+        prefix = config.get('carrier_send_shipments', 'store_prefix',
+            default=None)
+        if prefix is None:
+            prefix = transaction.database.name
+
+        if to == 'filestore':
+            where = column != Null
+        else:
+            where = (column_id != Null) & (column_id != '')
+        last_id, count = 0, 0
+        while True:
+            # only the labels of a batch are loaded in memory
+            cursor.execute(*table.select(table.id, column, column_id,
+                    where=where & (table.id > last_id),
+                    order_by=[table.id.asc], limit=batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for shipment_id, data, label_id in rows:
+                if to == 'filestore':
+                    values = [filestore.set(bytes(data), prefix=prefix), None]
+                else:
+                    try:
+                        data = filestore.get(label_id, prefix=prefix)
+                    except (IOError, OSError):
+                        logger.warning('Could not read the label %s of the '
+                            'shipment %s', label_id, shipment_id)
+                        continue
+                    values = [None, field.sql_format(data)]
+                cursor.execute(*table.update([column_id, column], values,
+                        where=table.id == shipment_id))
+                count += 1
+            last_id = rows[-1][0]
+            transaction.commit()
+            logger.info('Moved %s carrier labels to the %s', count, to)
 
     def check_shipment_state(self):
         if self.state not in _SHIPMENT_STATES:
@@ -323,6 +1218,13 @@ class ShipmentOut(metaclass=PoolMeta):
                 state=self.state,
                 states=', '.join(_SHIPMENT_STATES)))
 
+    def check_send_state(self):
+        if (self.carrier_send_state in {'queued', 'sending'}
+                and not self.carrier_send_state_stale):
+            raise UserError(gettext(
+                'carrier_send_shipments.msg_shipment_sending',
+                shipment=self.number))
+
     def check_shipment_carrier(self):
         if not self.carrier:
             raise UserError(gettext(
@@ -342,21 +1244,74 @@ class ShipmentOut(metaclass=PoolMeta):
                 name=self.carrier.rec_name))
 
     def check_postal_code(self):
-        api, = self.carrier.apis
+        api = self.carrier.apis[0]
+        postal_code = (self.delivery_address.postal_code
+            if self.delivery_address else None)
         if api.zips:
-            zips = api.zips.split(',')
-            if (self.delivery_address.postal_code and
-                    self.delivery_address.postal_code in zips):
+            if postal_code in postal_code_index(api.zips):
                 raise UserError(gettext(
                     'carrier_send_shipments.msg_shipment_postal_code',
                     shipment=self.number,
-                    postal_code=self.delivery_address.postal_code))
+                    postal_code=postal_code))
+
+    def get_carrier_send_checks(self):
+        '''Return the list of check methods to run before sending the
+        shipment to the carrier
+
+        Each item is a tuple with the method, which raises a UserError, and
+        whether the next checks are skipped when it fails. Modules can
+        extend the list or override the check_* methods.
+        '''
+        return [
+            (self.check_shipment_state, False),
+            (self.check_send_state, False),
+            (self.check_shipment_carrier, True),
+            (self.check_duplicate_package, False),
+            (self.check_api, True),
+            (self.check_postal_code, False),
+            ]
+
+    @classmethod
+    def get_carrier_send_errors(cls, shipments):
+        '''Return a dictionary with the list of errors which prevent to send
+        each shipment to the carrier
+
+        It runs the checks of get_carrier_send_checks on the shipments browsed
+        together so their fields are read at once.
+        '''
+        errors = {}
+        for shipment in cls.browse(shipments):
+            shipment_errors = errors[shipment.id] = []
+            for check, required in shipment.get_carrier_send_checks():
+                try:
+                    check()
+                except UserError as exception:
+                    shipment_errors.append(exception.message)
+                    if required:
+                        break
+        return errors
+
+    @classmethod
+    def check_carrier_send(cls, shipments):
+        'Raise a single error with all the errors of the shipments'
+        errors = cls.get_carrier_send_errors(shipments)
+        messages = [e for s in shipments for e in errors[s.id]]
+        if messages:
+            raise UserError(gettext(
+                    'carrier_send_shipments.msg_shipments_not_valid',
+                    errors='\n'.join(messages)))
 
 class CarrierSendShipmentsStart(ModelView):
     'Carrier Send Shipments Start'
     __name__ = 'carrier.send.shipments.start'
     shipments = fields.Many2Many('stock.shipment.out', None, None,
         'Shipments', readonly=True)
+    background = fields.Boolean('Background',
+        help='Send the shipments in background tasks and close the wizard')
+
+    @staticmethod
+    def default_background():
+        return send_background
 
 
 class CarrierSendShipmentsResult(ModelView):
@@ -392,18 +1347,21 @@ class CarrierSendShipments(Wizard):
         info = None
         carrier_labels = None
         file_name = None
-        references = []
-        labels = []
-        errors = []
 
         active_ids = context.get('active_ids')
         if active_ids:
-            for shipment in Shipment.browse(active_ids):
-                refs, labs, errs = Shipment.send_shipment_api(shipment)
-
-                references += refs
-                labels += labs
-                errors += errs
+            # the shipments may have been sent since the wizard was opened
+            self.validate_shipment(Shipment.browse(active_ids))
+        if active_ids and self.start.background:
+            shipments = Shipment.browse(active_ids)
+            Shipment.send_shipments_api_background(shipments)
+            info = gettext('carrier_send_shipments.msg_shipment_queued',
+                shipments=', '.join(s.rec_name for s in shipments))
+        elif active_ids:
+            with instrument.phase('send') as record:
+                references, labels, errors = Shipment.send_shipments_api(
+                    Shipment.browse(active_ids))
+                record.add(items=len(active_ids))
 
             #  Save results in info and labels fields
             info = gettext('carrier_send_shipments.msg_shipment_info',
@@ -411,21 +1369,11 @@ class CarrierSendShipments(Wizard):
                 errors=', '.join(errors) if errors else '')
 
             #  Save file label in labels field
-            if len(labels) == 1:  # A label generate simple file
-                label, = labels
-                carrier_labels = fields.Binary.cast(open(label, "rb").read())
-                file_name = label.split('/')[2]
-            elif len(labels) > 1:  # Multiple labels generate tgz
-                temp = tempfile.NamedTemporaryFile(
-                    prefix='%s-carrier-' % dbname, delete=False)
-                temp.close()
-                with tarfile.open(temp.name, "w:gz") as tar:
-                    for path_label in labels:
-                        tar.add(path_label)
-                tar.close()
-                carrier_labels = fields.Binary.cast(
-                    open(temp.name, "rb").read())
-                file_name = '%s.tgz' % temp.name.split('/')[2]
+            with instrument.phase('send.bundle') as record:
+                carrier_labels, file_name = bundle_labels(labels,
+                    '%s-carrier' % dbname)
+                if record and carrier_labels:
+                    record.add(bytes=len(carrier_labels), items=len(labels))
 
         self.result.info = info
         self.result.labels = carrier_labels
@@ -448,12 +1396,10 @@ class CarrierSendShipments(Wizard):
         return default
 
     def validate_shipment(self, shipments):
-        for shipment in shipments:
-            shipment.check_shipment_state()
-            shipment.check_shipment_carrier()
-            shipment.check_duplicate_package()
-            shipment.check_api()
-            shipment.check_postal_code()
+        Shipment = Pool().get('stock.shipment.out')
+        with instrument.phase('send.validate') as record:
+            Shipment.check_carrier_send(shipments)
+            record.add(items=len(shipments))
 
     def default_result(self, fields):
         return {
@@ -472,11 +1418,18 @@ class CarrierPrintShipmentStart(ModelView):
     __name__ = 'carrier.print.shipment.start'
     shipments = fields.Many2Many('stock.shipment.out', None, None,
         'Shipments', readonly=True)
+    refresh = fields.Boolean('Refresh',
+        help='Download the labels from the carrier API even if they are '
+        'stored in the shipments')
 
     @staticmethod
     def default_shipments():
         return Transaction().context.get('active_ids')
 
+    @staticmethod
+    def default_refresh():
+        return False
+
 
 class CarrierPrintShipmentResult(ModelView):
     'Carrier Print Shipment Result'
@@ -528,59 +1481,100 @@ class CarrierPrintShipment(Wizard):
         pool = Pool()
         Shipment = pool.get('stock.shipment.out')
         API = pool.get('carrier.api')
-        Attachment = pool.get('ir.attachment')
 
         dbname = Transaction().database.name
         labels = []
+        to_attach = []
 
         shipments = Shipment.search([
                 ('id', 'in', Transaction().context['active_ids']),
                 ])
+        stored_labels = self.get_stored_labels(shipments)
+        printed = []
         for shipment in shipments:
-            if not shipment.carrier:
-                continue
-            apis = API.search([('carriers', 'in', [shipment.carrier.id])],
-                limit=1)
-            if not apis:
+            api = API.get_carrier_api(shipment.carrier)
+            if not api:
                 continue
-            api, = apis
 
-            print_label = getattr(Shipment, 'print_labels_%s' % api.method)
-            labs = print_label(api, [shipment])
+            if shipment.id in stored_labels:
+                labs = [stored_labels[shipment.id]]
+                if not shipment.carrier_printed:
+                    printed.append(shipment)
+            else:
+                print_label = getattr(
+                    Shipment, 'print_labels_%s' % api.method)
+                with instrument.phase('print.carrier', api.method) as record:
+                    labs = print_label(api, [shipment])
+                    if record:
+                        record.add(bytes=instrument.labels_size(labs),
+                            items=1)
 
             if labs:
-                attach = Attachment(
-                    name=datetime.now().strftime("%y/%m/%d %H:%M:%S"),
-                    type='data',
-                    data=fields.Binary.cast(open(labs[0], "rb").read()),
-                    resource=str(shipment))
-                attach.save()
+                to_attach.append((shipment, labs[0]))
 
             labels += labs
 
+        # the print_labels methods mark the shipments they print
+        if printed:
+            Shipment.write(printed, {'carrier_printed': True})
+
+        with instrument.phase('print.attach') as record:
+            Shipment.attach_carrier_labels(to_attach)
+            record.add(items=len(to_attach))
+
         #  Save file label in labels field
-        if len(labels) == 1:  # A label generate simple file
-            label, = labels
-            carrier_labels = fields.Binary.cast(open(label, "rb").read())
-            file_name = label.split('/')[2]
-        elif len(labels) > 1:  # Multiple labels generate tgz
-            temp = tempfile.NamedTemporaryFile(prefix='%s-carrier-' % dbname,
-                delete=False)
-            temp.close()
-            with tarfile.open(temp.name, "w:gz") as tar:
-                for path_label in labels:
-                    tar.add(path_label)
-            tar.close()
-            carrier_labels = fields.Binary.cast(open(temp.name, "rb").read())
-            file_name = '%s.tgz' % temp.name.split('/')[2]
-        else:
-            carrier_labels = None
-            file_name = None
+        with instrument.phase('print.bundle') as record:
+            carrier_labels, file_name = bundle_labels(labels,
+                '%s-carrier' % dbname)
+            if record and carrier_labels:
+                record.add(bytes=len(carrier_labels), items=len(labels))
         self.result.labels = carrier_labels
         self.result.file_name = file_name
 
         return 'result'
 
+    def get_stored_labels(self, shipments):
+        '''Return a dictionary with the label stored in each shipment as a
+        (name, data) tuple
+
+        Only the labels which are not older than the maximum age of the
+        carrier API are returned and none when the refresh is requested.
+        '''
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        API = pool.get('carrier.api')
+
+        # the start view is not set when the wizard is run from the code
+        if getattr(self.start, 'refresh', False):
+            return {}
+
+        now = datetime.now()
+        labels = {}
+        with instrument.phase('print.stored') as record:
+            for sub_shipments in grouped_slice(shipments):
+                ids = []
+                for shipment in sub_shipments:
+                    api = API.get_carrier_api(shipment.carrier)
+                    if not api:
+                        continue
+                    max_age = Shipment.get_label_max_age(api)
+                    if max_age and (not shipment.carrier_send_date
+                            or now - shipment.carrier_send_date > max_age):
+                        continue
+                    ids.append(shipment.id)
+                # the labels are read by slices to not load all of them
+                for value in Shipment.read(ids,
+                        ['number', 'carrier_tracking_label']):
+                    if not value['carrier_tracking_label']:
+                        continue
+                    data = bytes(value['carrier_tracking_label'])
+                    name = '%s%s' % (
+                        slugify(value['number'] or str(value['id'])),
+                        guess_extension(data))
+                    labels[value['id']] = (name, data)
+                    record.add(bytes=len(data), items=1)
+        return labels
+
 
 class LabelReport(Report):
     __name__ = 'stock.shipment.out.label.report'
@@ -590,6 +1584,28 @@ class LabelReport(Report):
         super(LabelReport, cls).__setup__()
         cls.__rpc__['execute'] = RPC(False)
 
+    @classmethod
+    def get_labels(cls, api, shipments):
+        '''Return the labels of the shipments of the carrier API
+
+        The label stored in the shipment is used and the other labels are
+        requested at once to get_labels_<method>.
+        '''
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+
+        labels = [s.carrier_tracking_label for s in shipments]
+        missing = [i for i, label in enumerate(labels) if not label]
+        if missing and hasattr(Shipment, 'get_labels_%s' % api.method):
+            get_labels = getattr(Shipment, 'get_labels_%s' % api.method)
+            new_labels = get_labels(api, [shipments[i] for i in missing])
+            if len(new_labels or []) == len(missing):
+                for i, label in zip(missing, new_labels):
+                    labels[i] = label
+            else:
+                labels += new_labels or []
+        return [label for label in labels if label]
+
     @classmethod
     def execute(cls, ids, data):
         pool = Pool()
@@ -600,58 +1616,88 @@ class LabelReport(Report):
         action, model = cls.get_action(data)
         cls.check_access(action, model, ids)
 
-        if not ids or len(ids) != 1:
-            raise UserError(
-                    gettext('carrier_send_shipments.msg_several_shipments'))
-
-        action_id = data.get('action_id')
-        if action_id is None:
-            action_reports = ActionReport.search([
-                    ('report_name', '=', cls.__name__)
-                    ])
-            assert action_reports, '%s not found' % cls
-            action_report = action_reports[0]
-        else:
-            action_report = ActionReport(action_id)
-
-        shipment = Shipment(ids[0])
-        if not shipment.carrier:
+        if not ids:
             return
 
-        carrier_apis = API.search([
-            ('carriers', 'in', [shipment.carrier.id]),
-            ], limit=1)
-        if not carrier_apis:
-            return
-
-        api, = carrier_apis
-        if not api.print_report:
-            return
-
-        filename = slugify('%s-%s' % (api.method, action_report.name))
-
-        if not shipment.carrier_tracking_label:
-            if not hasattr(Shipment, 'get_labels_%s' % api.method):
-                return
-
-            print_label = getattr(Shipment, 'get_labels_%s' % api.method)
-            labels = print_label(api, [shipment])
-            if not labels:
-                return
-            label = labels[0]
-        else:
-            label = shipment.carrier_tracking_label
-
         Model = 'printer'
         Printer = None
         try:
             Printer = pool.get(Model)
         except KeyError:
+            if data.get('discard_result'):
+                # without printer there is nothing to do with the labels
+                return
             logger.warning('Redirect model "%s" not found.', Model)
 
-        if Printer:
-            return Printer.send_report(api.print_report, bytearray(label),
-                filename, action_report)
+        action_report = ActionReport.get_carrier_label_action(
+            action_id=data.get('action_id'), report_name=cls.__name__)
 
-        return (api.print_report, bytearray(label), action_report.direct_print,
+        groups = {}
+        for shipment in Shipment.browse(ids):
+            api = API.get_carrier_api(shipment.carrier)
+            if not api or not api.print_report:
+                continue
+            groups.setdefault(api.id, (api, []))[1].append(shipment)
+
+        # one payload per report format of the APIs
+        payloads = {}
+        for api, shipments in groups.values():
+            with instrument.phase('label_report.get_labels',
+                    api.method) as record:
+                labels = cls.get_labels(api, shipments)
+                if record:
+                    record.add(bytes=instrument.labels_size(labels),
+                        items=len(shipments))
+            if not labels:
+                continue
+            filename = slugify('%s-%s' % (api.method, action_report['name']))
+            payload = payloads.setdefault(api.print_report, (filename, []))
+            payload[1].extend(labels)
+        if not payloads:
+            return
+
+        if Printer:
+            result = None
+            action = ActionReport(action_report['id'])
+            for print_report, (filename, labels) in payloads.items():
+                for sub_labels in grouped_slice(labels, send_batch_size):
+                    sub_labels = list(sub_labels)
+                    data, file_name = cls.combine_labels(
+                        print_report, filename, sub_labels)
+                    if not file_name.endswith('.%s' % print_report):
+                        # labels which can not be merged are sent one by one
+                        datas = sub_labels
+                    else:
+                        datas = [data]
+                    for data in datas:
+                        with instrument.phase('label_report.print',
+                                print_report) as record:
+                            result = Printer.send_report(print_report,
+                                bytearray(data), filename, action)
+                            record.add(bytes=len(data), items=1)
+            return result
+
+        with instrument.phase('label_report.bundle') as record:
+            documents = []
+            for print_report, (filename, labels) in payloads.items():
+                data, file_name = cls.combine_labels(
+                    print_report, filename, labels)
+                documents.append((file_name, data))
+            if len(documents) == 1:
+                (file_name, data), = documents
+            else:
+                filename = slugify(action_report['name'])
+                data, file_name = bundle_labels(documents, filename)
+            record.add(bytes=len(data), items=len(documents))
+        report_type = os.path.splitext(file_name)[1][1:]
+        return (report_type, bytearray(data), action_report['direct_print'],
             filename)
+
+    @classmethod
+    def combine_labels(cls, print_report, filename, labels):
+        '''Return the data and the file name of the labels of the format
+        print_report merged in a single document or bundled in an archive if
+        they can not be merged'''
+        labels = [('%s-%s.%s' % (filename, i, print_report), label)
+            for i, label in enumerate(labels, 1)]
+        return bundle_labels(labels, filename, archive='merge')
@@ -0,0 +1,282 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''Benchmark of the send, print, label and manifest paths
+
+The shipments are sent to a simulated carrier API with the "bench" method
+which does not call any remote service. The benchmark only runs on SQLite
+when the CARRIER_BENCHMARK environment variable is set:
+
+    CARRIER_BENCHMARK=1 python -m unittest \\
+        trytond.modules.carrier_send_shipments.tests.test_benchmark
+
+It is configured with the environment variables:
+
+    CARRIER_BENCHMARK_SIZES: numbers of shipments (default: 10,100,1000)
+    CARRIER_BENCHMARK_LATENCY: seconds of each carrier call (default: 0.01)
+    CARRIER_BENCHMARK_LABEL_SIZE: bytes of each label (default: 20000)
+    CARRIER_BENCHMARK_FAILURE_RATE: ratio of rejected shipments (default: 0)
+
+The wall time, the number of SQL queries and the peak of memory allocated
+by Python are reported for each phase and number of shipments.
+'''
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.modules.carrier_send_shipments.instrument import count_queries
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    CONTEXT, DB_NAME, USER, activate_module, drop_db)
+from trytond.transaction import Transaction
+
+SIZES = [int(s) for s in os.getenv(
+        'CARRIER_BENCHMARK_SIZES', '10,100,1000').split(',')]
+LATENCY = float(os.getenv('CARRIER_BENCHMARK_LATENCY', 0.01))
+LABEL_SIZE = int(os.getenv('CARRIER_BENCHMARK_LABEL_SIZE', 20000))
+FAILURE_RATE = float(os.getenv('CARRIER_BENCHMARK_FAILURE_RATE', 0))
+
+
+class BenchCarrier(object):
+    'Simulated carrier API'
+
+    def __init__(self, directory, seed=0):
+        self.directory = directory
+        self.random = random.Random(seed)
+
+    def label_data(self, shipment):
+        body = b'^FD%s^FS' % shipment.number.encode()
+        filler = b'^FX' + b'0' * max(LABEL_SIZE - len(body) - 9, 0)
+        return b'^XA' + body + filler + b'^XZ'
+
+    def label_path(self, shipment):
+        path = os.path.join(self.directory, '%s.zpl' % shipment.id)
+        with open(path, 'wb') as fp:
+            fp.write(self.label_data(shipment))
+        return path
+
+    def send(self, Shipment, api, shipments):
+        time.sleep(LATENCY)
+        references, labels, errors = [], [], []
+        to_write = []
+        for shipment in shipments:
+            if self.random.random() < FAILURE_RATE:
+                errors.append('Rejected %s' % shipment.number)
+                continue
+            reference = 'BENCH%s' % shipment.id
+            references.append(reference)
+            labels.append(self.label_path(shipment))
+            to_write.extend(([shipment], {
+                        'carrier_tracking_ref': reference,
+                        'carrier_send_date': datetime.now(),
+                        }))
+        if to_write:
+            Shipment.write(*to_write)
+        return references, labels, errors
+
+    def print_labels(self, Shipment, api, shipments):
+        time.sleep(LATENCY)
+        return [self.label_path(s) for s in shipments]
+
+    def get_labels(self, Shipment, api, shipments):
+        time.sleep(LATENCY)
+        return [self.label_data(s) for s in shipments]
+
+    def get_manifest(self, wizard, api, from_date, to_date):
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        time.sleep(LATENCY)
+        shipments = Shipment.search([
+                ('carrier', 'in', [c.id for c in api.carriers]),
+                ('carrier_send_date', '>=', from_date),
+                ('carrier_send_date', '<', to_date),
+                ])
+        data = '\n'.join('%s;%s' % (s.number, s.carrier_tracking_ref)
+            for s in shipments)
+        return data.encode(), 'manifest.csv'
+
+    @contextmanager
+    def register(self):
+        'Register the "bench" method on the pool classes'
+        pool = Pool()
+        API = pool.get('carrier.api')
+        Shipment = pool.get('stock.shipment.out')
+        Manifest = pool.get('carrier.manifest', type='wizard')
+
+        selection = API.method.selection
+        if isinstance(selection, str):
+            getter = getattr(API, selection)
+            api_selection = patch.object(API, selection,
+                lambda *args: getter() + [('bench', "Bench")])
+        else:
+            api_selection = patch.object(API.method, 'selection',
+                selection + [('bench', "Bench")])
+        carrier = self
+        with api_selection, \
+                patch.object(Shipment, 'send_bench', classmethod(
+                        lambda cls, *args: carrier.send(cls, *args)),
+                    create=True), \
+                patch.object(Shipment, 'print_labels_bench', classmethod(
+                        lambda cls, *args: carrier.print_labels(cls, *args)),
+                    create=True), \
+                patch.object(Shipment, 'get_labels_bench', classmethod(
+                        lambda cls, *args: carrier.get_labels(cls, *args)),
+                    create=True), \
+                patch.object(Manifest, 'get_manifest_bench',
+                    lambda self, *args: carrier.get_manifest(self, *args),
+                    create=True):
+            yield
+
+
+@contextmanager
+def measure(results, phase, size):
+    'Record the time, the SQL queries and the peak memory of the phase'
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with count_queries() as queries:
+            yield
+    finally:
+        duration = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append((phase, size, duration, queries(), peak))
+
+
+@unittest.skipUnless(
+    os.getenv('CARRIER_BENCHMARK'), "CARRIER_BENCHMARK is not set")
+@unittest.skipUnless(backend.name == 'sqlite', "requires SQLite")
+class CarrierBenchmarkTestCase(unittest.TestCase):
+    'Benchmark CarrierSendShipments module'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        drop_db()
+        activate_module('carrier_send_shipments')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        drop_db()
+
+    def create_shipments(self, company, size):
+        pool = Pool()
+        Country = pool.get('country.country')
+        Party = pool.get('party.party')
+        ModelData = pool.get('ir.model.data')
+        Template = pool.get('product.template')
+        Carrier = pool.get('carrier')
+        API = pool.get('carrier.api')
+        Location = pool.get('stock.location')
+        Shipment = pool.get('stock.shipment.out')
+
+        country = Country(name="Spain", code='ES')
+        country.save()
+        customer = Party(name="Customer", addresses=[{
+                    'street': "Calle Mayor, 1",
+                    'postal_code': '08001',
+                    'city': "Barcelona",
+                    'country': country.id,
+                    }])
+        customer.save()
+        address, = customer.addresses
+
+        template = Template(name="Carrier", type='service',
+            default_uom=ModelData.get_id('product', 'uom_unit'),
+            products=[{}])
+        template.save()
+        product, = template.products
+        carrier_party = Party(name="Carrier")
+        carrier_party.save()
+        carrier = Carrier(party=carrier_party, carrier_product=product)
+        carrier.save()
+
+        api = API(name="Bench", method='bench', carriers=[carrier])
+        if 'company' in API._fields:
+            api.company = company
+        if isinstance(API.print_report.selection, list):
+            api.print_report = next(
+                (k for k, _ in API.print_report.selection if k), None)
+        api.save()
+
+        warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+        shipments = Shipment.create([{
+                    'customer': customer.id,
+                    'delivery_address': address.id,
+                    'carrier': carrier.id,
+                    'company': company.id,
+                    'warehouse': warehouse.id,
+                    }] * size)
+        Shipment.write(shipments, {'state': 'packed'})
+        return api, shipments
+
+    def run_phases(self, results, size, directory):
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Send = pool.get('carrier.send.shipments', type='wizard')
+        Print = pool.get('carrier.print.shipment', type='wizard')
+        Manifest = pool.get('carrier.manifest', type='wizard')
+        LabelReport = pool.get(
+            'stock.shipment.out.label.report', type='report')
+
+        company = create_company()
+        with set_company(company), \
+                BenchCarrier(directory).register():
+            api, shipments = self.create_shipments(company, size)
+            ids = [s.id for s in shipments]
+            context = {
+                'active_model': 'stock.shipment.out',
+                'active_ids': ids,
+                'active_id': ids[0],
+                }
+            with Transaction().set_context(context):
+                with measure(results, 'validate', size):
+                    Shipment.check_carrier_send(Shipment.browse(ids))
+
+                session_id, _, _ = Send.create()
+                send = Send(session_id)
+                send.start.background = False
+                with measure(results, 'send', size):
+                    send.transition_send()
+
+                session_id, _, _ = Print.create()
+                print_ = Print(session_id)
+                print_.start.refresh = False
+                with measure(results, 'print', size):
+                    print_.transition_print_()
+
+                with measure(results, 'label', size):
+                    LabelReport.execute(ids, {'model': Shipment.__name__})
+
+            session_id, _, _ = Manifest.create()
+            manifest = Manifest(session_id)
+            manifest.start.carrier_api = api
+            manifest.start.from_date = datetime.now() - timedelta(days=1)
+            manifest.start.to_date = datetime.now() + timedelta(days=1)
+            with measure(results, 'manifest', size):
+                manifest.transition_manifest()
+
+    def test_benchmark(self):
+        "Benchmark the send, print, label and manifest paths"
+        results = []
+        for size in SIZES:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT), \
+                    tempfile.TemporaryDirectory() as directory:
+                try:
+                    self.run_phases(results, size, directory)
+                finally:
+                    Transaction().rollback()
+
+        print('\n%-10s %10s %10s %10s %12s' % (
+                'phase', 'shipments', 'seconds', 'queries', 'peak KiB'))
+        for phase, size, duration, queries, peak in results:
+            print('%-10s %10d %10.3f %10d %12.1f' % (
+                    phase, size, duration, queries, peak / 1024))
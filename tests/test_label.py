@@ -0,0 +1,246 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from unittest.mock import patch
+
+from trytond.model import fields
+from trytond.modules.carrier_send_shipments import label
+from trytond.modules.carrier_send_shipments.label import (
+    COMPRESSED_MARKER, LabelBinary, bundle_labels, compress_label,
+    decompress_label, guess_extension, label_name, merge_labels, read_label)
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+
+def zpl(text):
+    return b'^XA^FD' + text.encode() + b'^FS^XZ'
+
+
+def pdf(*widths):
+    writer = PdfWriter()
+    for width in widths:
+        writer.add_blank_page(width=width, height=100)
+    fp = io.BytesIO()
+    writer.write(fp)
+    return fp.getvalue()
+
+
+class LabelTestCase(unittest.TestCase):
+    'Test label'
+
+    def test_label_name_and_data(self):
+        "Test label name and data of paths and tuples"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'label.zpl')
+            with open(path, 'wb') as fp:
+                fp.write(zpl('path'))
+            self.assertEqual(label_name(path), 'label.zpl')
+            self.assertEqual(read_label(path), zpl('path'))
+        self.assertEqual(label_name(('tuple.zpl', zpl('tuple'))), 'tuple.zpl')
+        self.assertEqual(
+            read_label(('tuple.zpl', bytearray(zpl('tuple')))), zpl('tuple'))
+
+    def test_guess_extension(self):
+        "Test guess extension"
+        for data, extension in [
+                (b'%PDF-1.4', '.pdf'),
+                (b'\x89PNG\r\n', '.png'),
+                (zpl('label'), '.zpl'),
+                (b'unknown', ''),
+                ]:
+            with self.subTest(data=data):
+                self.assertEqual(guess_extension(data), extension)
+
+    def test_bundle_labels_empty(self):
+        "Test bundle no labels"
+        self.assertEqual(bundle_labels([], 'labels'), (None, None))
+
+    def test_bundle_labels_single(self):
+        "Test bundle a single label"
+        self.assertEqual(bundle_labels([('a.zpl', zpl('a'))], 'labels'),
+            (zpl('a'), 'a.zpl'))
+
+    def test_bundle_labels_tgz(self):
+        "Test bundle labels in a gzipped tar"
+        data, file_name = bundle_labels(
+            [('a.zpl', zpl('a')), ('b.pdf', b'%PDF-1.4')], 'labels',
+            archive='tgz')
+        self.assertTrue(file_name.startswith('labels-'))
+        self.assertTrue(file_name.endswith('.tgz'))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['a.zpl', 'b.pdf'])
+            self.assertEqual(tar.extractfile('a.zpl').read(), zpl('a'))
+
+    def test_bundle_labels_tar(self):
+        "Test bundle compressed labels in a plain tar"
+        data, file_name = bundle_labels(
+            [('a.pdf', b'%PDF-a'), ('b.png', b'\x89PNG-b')], 'labels',
+            archive='tgz')
+        self.assertTrue(file_name.endswith('.tar'))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+            self.assertEqual(tar.getnames(), ['a.pdf', 'b.png'])
+            self.assertEqual(tar.extractfile('b.png').read(), b'\x89PNG-b')
+
+    def test_bundle_labels_zip(self):
+        "Test bundle labels in a zip"
+        data, file_name = bundle_labels(
+            [('a.zpl', zpl('a')), ('b.pdf', b'%PDF-b')], 'labels',
+            archive='zip')
+        self.assertTrue(file_name.endswith('.zip'))
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_:
+            self.assertEqual(zip_.namelist(), ['a.zpl', 'b.pdf'])
+            self.assertEqual(
+                zip_.getinfo('a.zpl').compress_type, zipfile.ZIP_DEFLATED)
+            self.assertEqual(
+                zip_.getinfo('b.pdf').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zip_.read('b.pdf'), b'%PDF-b')
+
+    def test_bundle_labels_unknown_archive(self):
+        "Test bundle labels with an unknown archive falls back to tgz"
+        _, file_name = bundle_labels(
+            [('a.zpl', zpl('a')), ('b.zpl', zpl('b'))], 'labels',
+            archive='rar')
+        self.assertTrue(file_name.endswith('.tgz'))
+
+    def test_merge_labels_text(self):
+        "Test merge text labels in order"
+        labels = [
+            ('1.zpl', zpl('1')),
+            ('2.png', b'\x89PNG-2'),
+            ('3.zpl', zpl('3')),
+            ('4.epl', b'N\nA4\nP1\n'),
+            ('5.zpl', zpl('5')),
+            ]
+        merged = merge_labels(labels)
+        self.assertEqual(merged, [
+                ('labels.zpl', zpl('1') + zpl('3') + zpl('5')),
+                ('2.png', b'\x89PNG-2'),
+                ('4.epl', b'N\nA4\nP1\n'),
+                ])
+
+    def test_bundle_labels_merge_zpl(self):
+        "Test bundle labels merged in a single ZPL"
+        data, file_name = bundle_labels(
+            [('a.zpl', zpl('a')), ('b.zpl', zpl('b'))], 'labels',
+            archive='merge')
+        self.assertEqual(data, zpl('a') + zpl('b'))
+        self.assertTrue(file_name.startswith('labels-'))
+        self.assertTrue(file_name.endswith('.zpl'))
+
+    def test_bundle_labels_merge_mixed(self):
+        "Test bundle labels which can not be merged in an archive"
+        data, file_name = bundle_labels(
+            [('a.zpl', zpl('a')), ('b.csv', b'b'), ('c.zpl', zpl('c'))],
+            'labels', archive='merge')
+        self.assertTrue(file_name.endswith('.tgz'))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['labels.zpl', 'b.csv'])
+            self.assertEqual(tar.extractfile('labels.zpl').read(),
+                zpl('a') + zpl('c'))
+
+    @unittest.skipUnless(PdfWriter, "requires pypdf")
+    def test_bundle_labels_merge_pdf(self):
+        "Test bundle PDF labels merged in a single PDF in order"
+        labels = [
+            ('a.pdf', pdf(100)),
+            ('b.pdf', pdf(200, 300)),
+            ('c.pdf', pdf(400)),
+            ]
+        data, file_name = bundle_labels(labels, 'labels', archive='merge')
+        self.assertTrue(file_name.endswith('.pdf'))
+        self.assertEqual(
+            [float(p.mediabox.width)
+                for p in PdfReader(io.BytesIO(data)).pages],
+            [100, 200, 300, 400])
+
+
+class LabelCompressionTestCase(unittest.TestCase):
+    'Test label compression'
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(label, 'label_compress', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_compress_label(self):
+        "Test compress label round trip"
+        data = zpl('label') * 100
+        compressed = compress_label(data)
+        self.assertTrue(compressed.startswith(COMPRESSED_MARKER))
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(decompress_label(compressed), data)
+
+    def test_compress_label_disabled(self):
+        "Test compress label when disabled"
+        data = zpl('label') * 100
+        with patch.object(label, 'label_compress', False):
+            self.assertIs(compress_label(data), data)
+
+    def test_compress_label_not_smaller(self):
+        "Test compress label which does not reduce its size"
+        data = os.urandom(1024)
+        self.assertEqual(compress_label(data), data)
+
+    def test_compress_label_compressed(self):
+        "Test compress label already compressed"
+        compressed = compress_label(zpl('label') * 100)
+        self.assertEqual(compress_label(compressed), compressed)
+
+    def test_compress_label_empty(self):
+        "Test compress empty label"
+        for data in [None, b'']:
+            with self.subTest(data=data):
+                self.assertEqual(compress_label(data), data)
+
+    def test_decompress_label_uncompressed(self):
+        "Test decompress label stored without compression"
+        for data in [None, b'', zpl('label'), b'%PDF-1.4',
+                bytearray(b'data')]:
+            with self.subTest(data=data):
+                self.assertEqual(decompress_label(data), data)
+
+    def test_decompress_label_memoryview(self):
+        "Test decompress label read as memoryview"
+        data = zpl('label') * 100
+        compressed = memoryview(compress_label(data))
+        self.assertEqual(decompress_label(compressed), data)
+
+    def test_label_binary_get(self):
+        "Test label binary get decompresses only the compressed values"
+        data = zpl('label') * 100
+        stored = {
+            1: compress_label(data),
+            2: data,
+            3: None,
+            }
+        field = LabelBinary('Label')
+        with patch.object(fields.Binary, 'get',
+                side_effect=lambda *args, **kwargs: dict(stored)):
+            self.assertEqual(field.get([1, 2, 3], None, 'label'),
+                {1: data, 2: data, 3: None})
+            self.assertEqual(field.get_stored([1, 2, 3], None, 'label'),
+                stored)
+
+    def test_label_binary_get_size(self):
+        "Test label binary get the size"
+        field = LabelBinary('Label')
+        with patch.object(fields.Binary, 'get', return_value={1: 42}):
+            self.assertEqual(field.get([1], None, 'label'), {1: 42})
+
+    def test_label_binary_set(self):
+        "Test label binary set compresses the values"
+        data = zpl('label') * 100
+        field = LabelBinary('Label')
+        with patch.object(fields.Binary, 'set') as set_:
+            field.set(None, 'label', [1], data, [2, 3], None)
+        set_.assert_called_once_with(
+            None, 'label', [1], compress_label(data), [2, 3], None)
@@ -1,14 +1,177 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime as dt
 
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class CarrierSendShipmentsTestCase(CompanyTestMixin, ModuleTestCase):
     'Test CarrierSendShipments module'
     module = 'carrier_send_shipments'
 
+    def carrier_weight_shipment(self, weight_unit, weight_api_unit, **values):
+        "Return a shipment of a carrier with an API of the weight units"
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Carrier = pool.get('carrier')
+        API = pool.get('carrier.api')
+
+        values.setdefault('manual_weight', None)
+        api = API(weight_unit=weight_unit, weight_api_unit=weight_api_unit)
+        return Shipment(carrier=Carrier(apis=[api]), **values)
+
+    @with_transaction()
+    def test_carrier_weights(self):
+        "Test carrier weights give the same result as the on change"
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+
+        kg, g, lb = Uom.browse([
+                ModelData.get_id('product', 'uom_kilogram'),
+                ModelData.get_id('product', 'uom_gram'),
+                ModelData.get_id('product', 'uom_pound'),
+                ])
+        names = ['carrier_weight', 'carrier_weight_uom']
+        for weight_unit, weight_api_unit, values in [
+                # factor to rate
+                (None, g, {'weight': 2.5, 'weight_uom': kg}),
+                (None, g, {'weight': 1.2, 'weight_uom': lb}),
+                # rate to factor
+                (None, lb, {'weight': 1500, 'weight_uom': g}),
+                # same unit
+                (None, kg, {'weight': 3.14159, 'weight_uom': kg}),
+                # unit of the API
+                (lb, kg, {'weight': 10, 'weight_uom': None}),
+                # manual weight
+                (None, g, {
+                        'weight': 2, 'manual_weight': 5, 'weight_uom': kg}),
+                # fallback of the empty weight
+                (None, g, {'weight': 0, 'weight_uom': kg}),
+                (None, g, {'weight': 0.0, 'weight_uom': lb}),
+                # without unit of the API
+                (kg, None, {'weight': 7, 'weight_uom': g}),
+                ]:
+            with self.subTest(
+                    weight_unit=weight_unit, weight_api_unit=weight_api_unit,
+                    values=values):
+                shipment = self.carrier_weight_shipment(
+                    weight_unit, weight_api_unit, **values)
+                result = Shipment.get_carrier_weights([shipment], names)
+                self.assertEqual(result['carrier_weight'][shipment.id],
+                    shipment.on_change_with_carrier_weight())
+                self.assertEqual(result['carrier_weight_uom'][shipment.id],
+                    shipment.on_change_with_carrier_weight_uom())
+
+    @with_transaction()
+    def test_carrier_weights_other_category(self):
+        "Test carrier weights to a unit of another category"
+        pool = Pool()
+        Shipment = pool.get('stock.shipment.out')
+        Uom = pool.get('product.uom')
+        ModelData = pool.get('ir.model.data')
+
+        kg, unit = Uom.browse([
+                ModelData.get_id('product', 'uom_kilogram'),
+                ModelData.get_id('product', 'uom_unit'),
+                ])
+        shipment = self.carrier_weight_shipment(
+            None, unit, weight=2, weight_uom=kg)
+        with self.assertRaises(ValueError):
+            Shipment.get_carrier_weights([shipment], ['carrier_weight'])
+        with self.assertRaises(ValueError):
+            shipment.on_change_with_carrier_weight()
+
+    def mechanism(self, shipment, name):
+        "Return the mechanism of the shipment with the searches per shipment"
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        mechanisms = ContactMechanism.search([
+            ('party', '=', shipment.customer),
+            ('type', '=', name),
+            ('write_date', '!=', None),
+            ], order=[('write_date', 'DESC')], limit=1)
+        mechanism_write_date = mechanisms[0] if mechanisms else None
+        mechanisms = ContactMechanism.search([
+            ('party', '=', shipment.customer),
+            ('type', '=', name),
+            ], order=[('create_date', 'DESC')], limit=1)
+        mechanism_create_date = mechanisms[0] if mechanisms else None
+        if mechanism_write_date and mechanism_create_date:
+            if (mechanism_write_date.write_date
+                    > mechanism_create_date.create_date):
+                return mechanism_write_date.value
+            return mechanism_create_date.value
+        elif mechanism_create_date:
+            return mechanism_create_date.value
+        elif mechanism_write_date:
+            return mechanism_write_date.value
+
+    @with_transaction()
+    def test_get_mechanisms(self):
+        "Test get mechanisms gives the same result as per shipment"
+        pool = Pool()
+        Party = pool.get('party.party')
+        ContactMechanism = pool.get('party.contact_mechanism')
+        Shipment = pool.get('stock.shipment.out')
+        cursor = Transaction().connection.cursor()
+        table = ContactMechanism.__table__()
+
+        party1, party2, party3 = Party.create([
+                {'name': 'Party 1', 'addresses': [('create', [{}])]},
+                {'name': 'Party 2', 'addresses': [('create', [{}])]},
+                {'name': 'Party 3', 'addresses': [('create', [{}])]},
+                ])
+        day = dt.datetime(2026, 1, 1)
+        mechanisms = {}
+        # create and write dates in days after day
+        for type_, value, party, create_date, write_date in [
+                # the last written after the last created
+                ('phone', '+34931111111', party1, 1, 5),
+                ('phone', '+34932222222', party1, 2, None),
+                ('phone', '+34933333333', party1, 3, None),
+                # the last created after the last written
+                ('mobile', '+34644444444', party1, 1, 2),
+                ('mobile', '+34655555555', party1, 3, None),
+                # only created
+                ('email', 'a@example.com', party1, 1, None),
+                ('email', 'b@example.com', party1, 2, None),
+                ('fax', '+34966666666', party2, 4, 6),
+                ]:
+            mechanism, = ContactMechanism.create([{
+                        'party': party.id,
+                        'type': type_,
+                        'value': value,
+                        }])
+            mechanisms[value] = mechanism
+            cursor.execute(*table.update(
+                    [table.create_date, table.write_date],
+                    [day + dt.timedelta(days=create_date),
+                        day + dt.timedelta(days=write_date)
+                        if write_date else None],
+                    where=table.id == mechanism.id))
+
+        names = ['phone', 'mobile', 'fax', 'email']
+        for party in [party1, party2, party3]:
+            with self.subTest(party=party.name):
+                shipment = Shipment(
+                    customer=party, delivery_address=party.addresses[0])
+                result = Shipment.get_mechanisms([shipment], names)
+                for name in names:
+                    self.assertEqual(result[name][shipment.id],
+                        self.mechanism(shipment, name))
+
+        shipment = Shipment(
+            customer=party1, delivery_address=party1.addresses[0])
+        result = Shipment.get_mechanisms([shipment], ['phone', 'mobile'])
+        self.assertEqual(result['phone'][shipment.id],
+            mechanisms['+34931111111'].value)
+        self.assertEqual(result['mobile'][shipment.id],
+            mechanisms['+34655555555'].value)
+
 
 del ModuleTestCase
@@ -0,0 +1,168 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from datetime import datetime, time, timedelta
+from unittest.mock import Mock, patch
+
+from trytond.modules.carrier_send_shipments import shipment
+from trytond.modules.carrier_send_shipments.manifest import CarrierManifest
+from trytond.modules.carrier_send_shipments.shipment import ShipmentOut
+
+
+class Config(object):
+    'Configuration of the carrier_send_shipments section'
+
+    def __init__(self, options):
+        self.options = options
+
+    def get(self, section, option, default=None):
+        return self.options.get(option, default)
+
+
+class ScheduleTestCase(unittest.TestCase):
+    'Test schedule'
+
+    def test_manifest_chunks_disabled(self):
+        "Test manifest chunks without days"
+        from_date = datetime(2026, 1, 1, 10)
+        to_date = datetime(2026, 1, 5, 10)
+        self.assertEqual(
+            CarrierManifest.manifest_chunks(from_date, to_date, 0),
+            [(from_date, to_date)])
+
+    def test_manifest_chunks_short(self):
+        "Test manifest chunks of a range shorter than the days"
+        from_date = datetime(2026, 1, 1, 10)
+        to_date = datetime(2026, 1, 2, 10)
+        self.assertEqual(
+            CarrierManifest.manifest_chunks(from_date, to_date, 1),
+            [(from_date, to_date)])
+
+    def test_manifest_chunks_days(self):
+        "Test manifest chunks split at midnight"
+        self.assertEqual(
+            CarrierManifest.manifest_chunks(
+                datetime(2026, 1, 1, 10), datetime(2026, 1, 3, 12), 1), [
+                (datetime(2026, 1, 1, 10), datetime(2026, 1, 2)),
+                (datetime(2026, 1, 2), datetime(2026, 1, 3)),
+                (datetime(2026, 1, 3), datetime(2026, 1, 3, 12)),
+                ])
+
+    def test_manifest_chunks_several_days(self):
+        "Test manifest chunks of several days"
+        self.assertEqual(
+            CarrierManifest.manifest_chunks(
+                datetime(2026, 1, 1, 10), datetime(2026, 1, 6), 2), [
+                (datetime(2026, 1, 1, 10), datetime(2026, 1, 3)),
+                (datetime(2026, 1, 3), datetime(2026, 1, 5)),
+                (datetime(2026, 1, 5), datetime(2026, 1, 6)),
+                ])
+
+    def test_auto_send_times(self):
+        "Test auto send times from the options"
+        api = Mock(method='bench')
+        with patch.object(shipment, 'config', Config({
+                        'auto_send_window': '08:00-20:00',
+                        'auto_send_cutoff': '18:00',
+                        'auto_send_cutoff_bench': ' 17:30 ',
+                        })):
+            self.assertEqual(ShipmentOut.get_auto_send_times(api),
+                ((time(8), time(20)), time(17, 30)))
+
+    def test_auto_send_times_empty(self):
+        "Test auto send times without options"
+        api = Mock(method='bench')
+        with patch.object(shipment, 'config', Config({})):
+            self.assertEqual(
+                ShipmentOut.get_auto_send_times(api), (None, None))
+
+    def auto_send_limit(self, window, cutoff, pending, now, interval=None):
+        api = Mock(method='bench')
+        with patch.object(ShipmentOut, 'get_auto_send_times',
+                return_value=(window, cutoff)):
+            return ShipmentOut.get_auto_send_limit(
+                api, pending, now, interval)
+
+    def test_auto_send_limit_unlimited(self):
+        "Test auto send limit without window nor cutoff"
+        self.assertEqual(
+            self.auto_send_limit(None, None, 10, datetime(2026, 1, 1, 3)), 10)
+
+    def test_auto_send_limit_window(self):
+        "Test auto send limit inside and outside the window"
+        window = (time(8), time(20))
+        for now, result in [
+                (datetime(2026, 1, 1, 7, 59), 0),
+                (datetime(2026, 1, 1, 8), 10),
+                (datetime(2026, 1, 1, 19, 59), 10),
+                (datetime(2026, 1, 1, 20), 0),
+                ]:
+            with self.subTest(now=now):
+                self.assertEqual(
+                    self.auto_send_limit(window, None, 10, now), result)
+
+    def test_auto_send_limit_window_midnight(self):
+        "Test auto send limit with a window over midnight"
+        window = (time(22), time(6))
+        for now, result in [
+                (datetime(2026, 1, 1, 23), 10),
+                (datetime(2026, 1, 1, 5), 10),
+                (datetime(2026, 1, 1, 12), 0),
+                ]:
+            with self.subTest(now=now):
+                self.assertEqual(
+                    self.auto_send_limit(window, None, 10, now), result)
+
+    def test_auto_send_limit_cutoff(self):
+        "Test auto send limit spread over the runs until the cutoff"
+        cutoff = time(18)
+        interval = timedelta(minutes=15)
+        for now, result in [
+                # 4 runs left: 17:00, 17:15, 17:30 and 17:45
+                (datetime(2026, 1, 1, 17), 3),
+                (datetime(2026, 1, 1, 17, 45), 10),
+                (datetime(2026, 1, 1, 17, 50), 10),
+                (datetime(2026, 1, 1, 18), 0),
+                (datetime(2026, 1, 1, 19), 0),
+                ]:
+            with self.subTest(now=now):
+                self.assertEqual(
+                    self.auto_send_limit(None, cutoff, 10, now, interval),
+                    result)
+
+    def test_auto_send_limit_cutoff_without_interval(self):
+        "Test auto send limit with cutoff but without cron interval"
+        self.assertEqual(
+            self.auto_send_limit(
+                None, time(18), 10, datetime(2026, 1, 1, 17)), 10)
+
+    def send_state_stale(self, state, write_date, timeout=60):
+        record = Mock(spec=['carrier_send_state', 'write_date',
+                'create_date', 'get_carrier_send_stale_date'],
+            carrier_send_state=state, write_date=write_date,
+            create_date=datetime(2026, 1, 1))
+        record.get_carrier_send_stale_date = (
+            ShipmentOut.get_carrier_send_stale_date)
+        with patch.object(shipment, 'send_state_timeout', timeout), \
+                patch.object(shipment, 'datetime') as datetime_:
+            datetime_.now.return_value = datetime(2026, 1, 1, 12)
+            return ShipmentOut.carrier_send_state_stale.fget(record)
+
+    def test_send_state_stale(self):
+        "Test send state stale after the timeout"
+        for state, write_date, result in [
+                ('sending', datetime(2026, 1, 1, 10, 59), True),
+                ('queued', datetime(2026, 1, 1, 10, 59), True),
+                ('sending', datetime(2026, 1, 1, 11, 30), False),
+                ('sending', None, True),
+                ('failed', datetime(2026, 1, 1, 10), False),
+                (None, datetime(2026, 1, 1, 10), False),
+                ]:
+            with self.subTest(state=state, write_date=write_date):
+                self.assertEqual(
+                    self.send_state_stale(state, write_date), result)
+
+    def test_send_state_stale_disabled(self):
+        "Test send state never stale without timeout"
+        self.assertFalse(
+            self.send_state_stale('sending', datetime(2025, 1, 1), 0))
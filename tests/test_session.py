@@ -0,0 +1,105 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from unittest.mock import patch
+
+from trytond.modules.carrier_send_shipments import session
+from trytond.modules.carrier_send_shipments.session import _Registry
+
+
+class Clock(object):
+    'Monotonic clock moved by hand'
+
+    def __init__(self):
+        self.now = 1000.
+
+    def monotonic(self):
+        return self.now
+
+
+@unittest.skipUnless(session.requests, "requires requests")
+class SessionTestCase(unittest.TestCase):
+    'Test session'
+
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.pid = 42
+        for patcher in [
+                patch.object(session, 'time', self.clock),
+                patch.object(session, 'idle_timeout', 300),
+                patch.object(session.os, 'getpid', lambda: self.pid),
+                ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.registry = _Registry()
+        self.addCleanup(self.registry.close)
+
+    def test_borrow_same_session(self):
+        "Test borrow the same session for the same key"
+        first = self.registry.borrow('a', 10)
+        second = self.registry.borrow('a', 20)
+        other = self.registry.borrow('b', 10)
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(first.timeout, 20)
+
+    def test_borrow_release_count(self):
+        "Test borrow and release count the borrowers"
+        self.registry.borrow('a', 10)
+        self.registry.borrow('a', 10)
+        self.assertEqual(self.registry.sessions['a'][2], 2)
+        self.registry.release('a')
+        self.assertEqual(self.registry.sessions['a'][2], 1)
+        self.assertEqual(self.registry.sessions['a'][1], 1000)
+        self.registry.release('a')
+        self.assertEqual(self.registry.sessions['a'][2], 0)
+
+    def test_release_unknown(self):
+        "Test release a key without session"
+        self.registry.release('a')
+        self.assertEqual(self.registry.sessions, {})
+
+    def test_evict_idle(self):
+        "Test the idle sessions are closed after the idle timeout"
+        first = self.registry.borrow('a', 10)
+        self.registry.release('a')
+        self.clock.now += 300
+        self.registry.borrow('b', 10)
+        self.registry.release('b')
+        self.assertIs(self.registry.sessions['a'][0], first)
+        self.clock.now += 1
+        with patch.object(first, 'close') as close:
+            self.registry.borrow('c', 10)
+        close.assert_called_once_with()
+        self.assertEqual(sorted(self.registry.sessions), ['b', 'c'])
+        self.assertIsNot(self.registry.borrow('a', 10), first)
+
+    def test_evict_borrowed(self):
+        "Test the borrowed sessions are never evicted"
+        first = self.registry.borrow('a', 10)
+        self.registry.borrow('a', 10)
+        self.registry.release('a')
+        self.clock.now += 1000
+        self.assertIs(self.registry.borrow('a', 10), first)
+
+    def test_fork_reset(self):
+        "Test the sessions of the parent process are not used after fork"
+        first = self.registry.borrow('a', 10)
+        self.registry.release('a')
+        self.pid = 43
+        with patch.object(first, 'close') as close:
+            second = self.registry.borrow('a', 10)
+        # the connections of the parent are not closed
+        close.assert_not_called()
+        self.assertIsNot(second, first)
+        self.assertEqual(self.registry.pid, 43)
+        self.assertEqual(list(self.registry.sessions), ['a'])
+
+    def test_close(self):
+        "Test close all the sessions"
+        first = self.registry.borrow('a', 10)
+        with patch.object(first, 'close') as close:
+            self.registry.close()
+        close.assert_called_once_with()
+        self.assertEqual(self.registry.sessions, {})
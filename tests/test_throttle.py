@@ -0,0 +1,133 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+from unittest.mock import patch
+
+from trytond.modules.carrier_send_shipments import throttle
+from trytond.modules.carrier_send_shipments.throttle import (
+    CircuitBreaker, RateLimiter)
+
+
+class Clock(object):
+    'Monotonic clock moved by hand'
+
+    def __init__(self):
+        self.now = 1000.
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ThrottleTestCase(unittest.TestCase):
+    'Test throttle'
+
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        patcher = patch.object(throttle, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_circuit_breaker_closed(self):
+        "Test circuit breaker allows calls below the failures"
+        breaker = CircuitBreaker(3, 60)
+        breaker.failure()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_circuit_breaker_success_resets(self):
+        "Test circuit breaker success resets the failures"
+        breaker = CircuitBreaker(3, 60)
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_breaker_open(self):
+        "Test circuit breaker rejects calls once open until the timeout"
+        breaker = CircuitBreaker(3, 60)
+        for _ in range(3):
+            breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.clock.now += 59
+        self.assertFalse(breaker.allow())
+
+    def test_circuit_breaker_half_open_success(self):
+        "Test circuit breaker closes when the probe succeeds"
+        breaker = CircuitBreaker(1, 60)
+        breaker.failure()
+        self.clock.now += 60
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half-open')
+        # only a single probe is allowed
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_breaker_half_open_failure(self):
+        "Test circuit breaker opens again when the probe fails"
+        breaker = CircuitBreaker(3, 60)
+        for _ in range(3):
+            breaker.failure()
+        self.clock.now += 60
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.clock.now += 60
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_breaker_half_open_expired(self):
+        "Test circuit breaker allows a new probe after the probe timeout"
+        breaker = CircuitBreaker(1, 60)
+        breaker.failure()
+        self.clock.now += 60
+        self.assertTrue(breaker.allow())
+        self.clock.now += 59
+        self.assertFalse(breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_circuit_breaker_disabled(self):
+        "Test circuit breaker without failures never opens"
+        breaker = CircuitBreaker(0, 60)
+        for _ in range(10):
+            breaker.failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_rate_limiter(self):
+        "Test rate limiter spaces the calls"
+        limiter = RateLimiter(4)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(self.clock.sleeps, [0.25, 0.25])
+
+    def test_rate_limiter_idle(self):
+        "Test rate limiter does not wait after an idle period"
+        limiter = RateLimiter(4)
+        limiter.wait()
+        self.clock.now += 1
+        limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_rate_limiter_disabled(self):
+        "Test rate limiter without rate never waits"
+        limiter = RateLimiter(0)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
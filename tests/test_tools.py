@@ -0,0 +1,178 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import random
+import timeit
+import unicodedata
+import unittest
+
+from trytond.modules.carrier_send_shipments.tools import (
+    PostalCodeIndex, postal_code_index, split_into_blocks, unaccent,
+    unaccent_many)
+
+
+def legacy_unaccent(text):
+    if not text:
+        return ''
+    for c in u"""/*+?¿!&$[]{}`^<>=~%|\\""":
+        text = text.replace(c, '')
+    text = text.replace('º', '. ')
+    text = text.replace('ª', '. ')
+    text = text.replace('  ', ' ')
+    output = unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore')
+    return output.decode('utf-8')
+
+
+def legacy_split_into_blocks(text, max_length=100):
+    words = text.split()
+    blocks = []
+    current_block = ""
+    for word in words:
+        if len(current_block) + len(word) + 1 <= max_length:
+            if current_block:
+                current_block += " " + word
+            else:
+                current_block = word
+        else:
+            blocks.append(current_block)
+            current_block = word
+    blocks.append(current_block)
+    remaining_words = " ".join(words[len(" ".join(blocks).split()):])
+    if remaining_words and len(remaining_words) <= max_length:
+        blocks.append(remaining_words)
+    return blocks
+
+
+def random_texts(count, seed=0):
+    alphabet = 'abcXYZ  ñçàéíóúüºª/*+?¿!&$[]{}`^<>=~%|\\ﬁ½€".,-0123'
+    generator = random.Random(seed)
+    return [''.join(generator.choice(alphabet)
+            for _ in range(generator.randint(0, 60)))
+        for _ in range(count)]
+
+
+class ToolsTestCase(unittest.TestCase):
+    'Test tools'
+
+    def test_unaccent(self):
+        "Test unaccent"
+        for text, result in [
+                (None, ''),
+                ('', ''),
+                ('Calle Mayor, 1', 'Calle Mayor, 1'),
+                ('Avda. Diagonal nº 640, 3ª planta',
+                    'Avda. Diagonal n. 640, 3. planta'),
+                ('Plaça Catalunya   s/n', 'Placa Catalunya  sn'),
+                ('Müller & Söhne {GmbH}', 'Muller Sohne GmbH'),
+                ('C/ Sant Joan <10> 2º 1ª', 'C Sant Joan 10 2. 1. '),
+                ('Ñandú ~ [piso] | "bajo"', 'Nandu piso "bajo"'),
+                ('ﬁ½ €uro', 'fi12 uro'),
+                ('¿Qué? ¡Sí!', 'Que Si'),
+                ]:
+            with self.subTest(text=text):
+                self.assertEqual(unaccent(text), result)
+
+    def test_unaccent_legacy(self):
+        "Test unaccent is the same as the legacy implementation"
+        for text in random_texts(5000):
+            with self.subTest(text=text):
+                self.assertEqual(unaccent(text), legacy_unaccent(text))
+
+    def test_unaccent_many(self):
+        "Test unaccent many"
+        texts = ['Crème brûlée', None, '', 'a/b', 'Crème brûlée']
+        self.assertEqual(unaccent_many(texts),
+            ['Creme brulee', '', '', 'ab', 'Creme brulee'])
+
+    def test_split_into_blocks(self):
+        "Test split into blocks"
+        for text, max_length, result in [
+                ('', 10, ['']),
+                ('uno dos tres cuatro cinco seis', 10,
+                    ['uno dos', 'tres', 'cuatro', 'cinco seis']),
+                ('palabramuylarga corta', 5,
+                    ['', 'palabramuylarga', 'corta']),
+                ('a b c', 1, ['', 'a', 'b', 'c']),
+                ('exacta', 6, ['', 'exacta']),
+                ('  varios   espacios  aqui ', 8,
+                    ['varios', 'espacios', 'aqui']),
+                ]:
+            with self.subTest(text=text, max_length=max_length):
+                self.assertEqual(
+                    split_into_blocks(text, max_length), result)
+
+    def test_split_into_blocks_legacy(self):
+        "Test split into blocks is the same as the legacy implementation"
+        for i, text in enumerate(random_texts(5000)):
+            max_length = i % 20 + 1
+            with self.subTest(text=text, max_length=max_length):
+                self.assertEqual(
+                    split_into_blocks(text, max_length),
+                    legacy_split_into_blocks(text, max_length))
+
+    def test_postal_code_index(self):
+        "Test postal code index"
+        index = PostalCodeIndex('08001, 07*,25000-25999\n 43001 ,,AD500')
+        for postal_code, result in [
+                ('08001', True),
+                (' 08001 ', True),
+                ('08002', False),
+                ('07001', True),
+                ('07', True),
+                ('17001', False),
+                ('25000', True),
+                ('25500', True),
+                ('25999', True),
+                ('26000', False),
+                ('2550', False),
+                ('255000', False),
+                ('43001', True),
+                ('AD500', True),
+                ('', False),
+                (None, False),
+                ]:
+            with self.subTest(postal_code=postal_code):
+                self.assertEqual(postal_code in index, result)
+
+    def test_postal_code_index_invalid_range(self):
+        "Test postal code index with invalid ranges as exact codes"
+        index = PostalCodeIndex('25999-25000,250-2599,A1-A9')
+        for postal_code, result in [
+                ('25500', False),
+                ('25999-25000', True),
+                ('251', False),
+                ('250-2599', True),
+                ('A5', False),
+                ('A1-A9', True),
+                ]:
+            with self.subTest(postal_code=postal_code):
+                self.assertEqual(postal_code in index, result)
+
+    def test_postal_code_index_empty(self):
+        "Test empty postal code index"
+        for zips in [None, '', ' , \n']:
+            with self.subTest(zips=zips):
+                self.assertNotIn('08001', PostalCodeIndex(zips))
+
+    def test_postal_code_index_cached(self):
+        "Test postal code index is cached by value"
+        self.assertIs(postal_code_index('08001'), postal_code_index('08001'))
+
+    @unittest.skipUnless(
+        os.getenv('CARRIER_BENCHMARK'), "CARRIER_BENCHMARK is not set")
+    def test_benchmark(self):
+        "Benchmark the text normalization"
+        texts = random_texts(1000, seed=1)
+        long_text = ' '.join(texts)
+        for name, legacy, function in [
+                ('unaccent',
+                    lambda: [legacy_unaccent(t) for t in texts],
+                    lambda: unaccent_many(texts)),
+                ('split_into_blocks',
+                    lambda: legacy_split_into_blocks(long_text, 35),
+                    lambda: split_into_blocks(long_text, 35)),
+                ]:
+            legacy_time = min(timeit.repeat(legacy, number=10, repeat=3))
+            time = min(timeit.repeat(function, number=10, repeat=3))
+            print('\n%s: legacy %.4fs, current %.4fs' % (
+                    name, legacy_time, time))
@@ -0,0 +1,109 @@
+# This file is part of the carrier_send_shipments module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import threading
+import time
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['RateLimiter', 'CircuitBreaker', 'get_throttle']
+
+SECTION = 'carrier_send_shipments'
+
+
+def _option(getter, name, method, default):
+    return getter(SECTION, '%s_%s' % (name, method),
+        default=getter(SECTION, name, default=default))
+
+
+class RateLimiter(object):
+    'Limit the calls to a number of requests per second'
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate > 0 else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class CircuitBreaker(object):
+    '''Stop calling after a number of consecutive failures
+
+    Once open, the calls are rejected until the timeout is reached. Then a
+    single probe call is allowed (half-open) which closes the circuit when it
+    succeeds or opens it again when it fails. A probe without result after
+    the timeout is abandoned and a new one is allowed.
+    '''
+
+    def __init__(self, failures, timeout):
+        self.max_failures = failures
+        self.timeout = timeout
+        self.failures = 0
+        self.state = 'closed'
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if not self.max_failures:
+            return True
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if (self.state in {'open', 'half-open'}
+                    and now - self.opened_at >= self.timeout):
+                # the half-open state starts the timeout of the probe
+                self.state = 'half-open'
+                self.opened_at = now
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = 'closed'
+            self.opened_at = None
+
+    def failure(self):
+        if not self.max_failures:
+            return
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'half-open'
+                    or self.failures >= self.max_failures):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_throttles = {}
+_throttles_lock = threading.Lock()
+
+
+def get_throttle(api):
+    '''Return the rate limiter and the circuit breaker of the carrier API
+
+    They are shared by the threads of the process and configured with the
+    rate_limit, breaker_failures and breaker_timeout options (or the
+    <option>_<method> variant for a method of API).
+    '''
+    key = (Transaction().database.name, api.id)
+    with _throttles_lock:
+        if key not in _throttles:
+            rate = _option(config.getfloat, 'rate_limit', api.method, 0)
+            failures = _option(
+                config.getint, 'breaker_failures', api.method, 5)
+            timeout = _option(
+                config.getfloat, 'breaker_timeout', api.method, 60)
+            _throttles[key] = (
+                RateLimiter(rate), CircuitBreaker(failures, timeout))
+        return _throttles[key]
@@ -2,50 +2,110 @@
 # This file is part of the carrier_send_shipments module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import re
 import unicodedata
+from functools import lru_cache
 
 SRC_CHARS = u"""/*+?¿!&$[]{}`^<>=~%|\\"""
+# A single pass of a character class is faster than str.translate or one
+# str.replace per character
+SRC_CHARS_RE = re.compile('[%s]' % re.escape(SRC_CHARS))
 
-def unaccent(text):
-    if not text:
-        return ''
-    for c in range(len(SRC_CHARS)):
-        text = text.replace(SRC_CHARS[c], '')
+
+@lru_cache(maxsize=4096)
+def _unaccent(text):
+    text = SRC_CHARS_RE.sub('', text)
     text = text.replace('º', '. ')
     text = text.replace('ª', '. ')
     text = text.replace('  ', ' ')
+    # NFKD does not change ASCII
+    if text.isascii():
+        return text
     output = unicodedata.normalize('NFKD', text).encode('ASCII', 'ignore')
     return output.decode('utf-8')
 
+def unaccent(text):
+    if not text:
+        return ''
+    return _unaccent(text)
+
+def unaccent_many(texts):
+    'Return the list of texts without accents'
+    return [_unaccent(t) if t else '' for t in texts]
+
 def unspaces(text):
     if text:
         return text.replace(" ", "")
     return ''
 
 def split_into_blocks(text, max_length=100):
-    words = text.split()
     blocks = []
-    current_block = ""
+    current_block = []
+    length = 0
 
-    for word in words:
+    for word in text.split():
         # Check if adding the next word would exceed the max_length
-        if len(current_block) + len(word) + 1 <= max_length:
+        if length + len(word) + 1 <= max_length:
             if current_block:
-                current_block += " " + word
+                length += len(word) + 1
             else:
-                current_block = word
+                length = len(word)
+            current_block.append(word)
         else:
             # If the current block is full, store it and start a new one
-            blocks.append(current_block)
-            current_block = word
+            blocks.append(' '.join(current_block))
+            current_block = [word]
+            length = len(word)
 
     # Add the last block
-    blocks.append(current_block)
+    blocks.append(' '.join(current_block))
+    return blocks
 
-    # Handle any remaining words for the last block, making sure it doesn'
-    # exceed max_length characters
-    remaining_words = " ".join(words[len(" ".join(blocks).split()):])
-    if remaining_words and len(remaining_words) <= max_length:
-        blocks.append(remaining_words)
 
-    return blocks
+class PostalCodeIndex(object):
+    '''Index of postal codes
+
+    The codes are separated by commas or new lines and can be exact codes
+    (08001), prefixes (08*) or ranges of numeric codes of the same length
+    (08001-08999).
+    '''
+
+    def __init__(self, zips):
+        self.codes = set()
+        self.ranges = []
+        prefixes = []
+        for code in (zips or '').replace('\n', ',').split(','):
+            code = code.strip()
+            if not code:
+                continue
+            if code.endswith('*'):
+                prefixes.append(code[:-1])
+                continue
+            start, _, end = code.partition('-')
+            if (start.isdigit() and end.isdigit()
+                    and len(start) == len(end) and start <= end):
+                self.ranges.append((start, end))
+            else:
+                self.codes.add(code)
+        self.prefixes = tuple(prefixes)
+
+    def __contains__(self, postal_code):
+        if not postal_code:
+            return False
+        postal_code = postal_code.strip()
+        if postal_code in self.codes:
+            return True
+        if self.prefixes and postal_code.startswith(self.prefixes):
+            return True
+        if self.ranges and postal_code.isdigit():
+            for start, end in self.ranges:
+                if (len(start) == len(postal_code)
+                        and start <= postal_code <= end):
+                    return True
+        return False
+
+
+@lru_cache(maxsize=128)
+def postal_code_index(zips):
+    'Return the PostalCodeIndex of zips cached by its value'
+    return PostalCodeIndex(zips)